@@ -2,20 +2,81 @@
 Api to interface with a bento server
 """
 
+import asyncio
+from collections import deque
+from itertools import takewhile
 import socket
 
 from bento.common.protocol import *
 
 
+""" function message types a server sends to a client """
+_messages= {
+    MsgTypes.Output: Output,
+    MsgTypes.Error: Error,
+    MsgTypes.FunctionErr: FunctionErr,
+    MsgTypes.Stream: Stream,
+    MsgTypes.StreamEnd: StreamEnd,
+}
+
+
+def _parse_message(msg_type, data, compressions):
+    """
+    deserialize a function message, decompressing its data with the compression of its session
+    """
+    msg_type, compressed= FunctionMessage.split_type(msg_type)
+    msg= _messages[msg_type].deserialize(data)
+    if compressed:
+        msg.compressed= True
+        if msg.function_id not in compressions:
+            raise Exception("compressed message from a session without compression")
+        compressions[msg.function_id].decompress(msg)
+    if msg.type == MsgTypes.FunctionErr and bytes(msg.data) == b"function dead":
+        compressions.pop(msg.function_id, None)
+    return msg
+
+
+def _parse_response(resp_type, errbyte, data):
+    """
+    deserialize a response body according to its header
+    """
+    if errbyte == 0x0:
+        if resp_type == Types.Execute:
+            return ExecuteResponse.deserialize(data)
+        elif resp_type == Types.Store:
+            return StoreResponse.deserialize(data)
+        elif resp_type == Types.Metrics:
+            return MetricsResponse.deserialize(data)
+        raise Exception("bad response type from server")
+    else:
+        return ErrorResponse.deserialize(data, resp_type) 
+
+
 class ClientConnection:
     """
     represents a connection with a Bento server in order to allow exchanging requests/responses 
-    with a Bento server as well as data with an executing function
+    with a Bento server as well as data with any number of executing functions
+        - version: protocol version requests are encoded with, use Versions.V1 to talk to servers
+          that predate binary requests
+        - window: bytes of output each open function may send ahead of what was read, credit is
+          granted again as output is read so a slow reader holds the function back, None for
+          no flow control
+        - compress: ask the server to compress the messages of every function opened, input is
+          then compressed as well, needs a v2 connection
     """
     
-    def __init__(self, address: str, port: int):
+    def __init__(self, address: str, port: int, version: int=Versions.Latest, window: int=None,
+                 compress: bool=False):
         self.conn= socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.conn.connect((address, port))
+        self.recvbuff= RecvBuffer(self.conn)
+        self.version= version
+        self.window= window
+        self.consumed= {}
+        self.compress= compress and version != Versions.V1
+        self.compressions= {}
+        self.pending= deque()
+        self.readers= {}
 
 
     def send_store_request(self, name, code):
@@ -42,13 +103,36 @@ class ClientConnection:
         return (response.function_id, None) if response.success == True else (None, response.errmsg)
         
 
+    def send_metrics_request(self):
+        """
+        send a synchronous request for the server's metrics in the prometheus text format
+        """
+        self._send_request(MetricsRequest())
+        response= self._get_response()
+        if response.resp_type != Types.Metrics:
+            raise Exception("Request-Response types don't match")
+        return (response.text, None) if response.success == True else (None, response.errmsg)
+
+
     def send_open_request(self, function_id):
         """
         send an asynchronous open request that informs the server that the client wants to begin
         exchanging data with a funciton 
             - no response expected, any errors will be sent in subsequent function error messages
         """
-        request= OpenRequest(function_id)
+        flags= 0
+        if self.compress:
+            flags|= OpenRequest.Compress
+            self.compressions.setdefault(function_id, Compression())
+        window= None
+        if self.window:
+            self.consumed[function_id]= 0
+            # v1 open requests can't carry the window, the server keeps credit granted ahead
+            if self.version == Versions.V1:
+                self.grant_credit(function_id, self.window)
+            else:
+                window= self.window
+        request= OpenRequest(function_id, flags, window)
         self._send_request(request)
 
 
@@ -61,6 +145,7 @@ class ClientConnection:
         """
         request= CloseRequest(function_id)
         self._send_request(request)
+        self.consumed.pop(function_id, None)
 
 
     def send_input(self, function_id, data):
@@ -73,79 +158,456 @@ class ClientConnection:
         if isinstance(data, str):
             data= data.encode()
         msg= Input(function_id, data)
-        return self.conn.sendall(msg.serialize())
+        if function_id in self.compressions:
+            msg= self.compressions[function_id].compress(msg)
+        return send_buffers(self.conn, msg.buffers())
+
+
+    def grant_credit(self, function_id, amount):
+        """
+        let an open function send amount more bytes of output, see window
+        """
+        send_buffers(self.conn, Credit(function_id, amount).buffers())
 
 
-    def recv_output(self):
+    def recv_output(self, function_id=None):
         """
         get output data from an executing function assuming there is a function instance running
             - return output data and whether data is stderr or stdout, raise exception if server error
+            - with several instances open, pass function_id to get the next output of that instance
+            - data is returned as bytes, recv_message hands it out without a copy
+            - chunks of streamed output are returned as output and the end of a stream as empty
+              output
         """
-        hdr= self._recv_all(FunctionMessage.HeaderLen)
-        if hdr is None:
-            raise Exception('failed to recv header')
+        msg= self.recv_message(function_id)
 
-        msg_type, length, err= FunctionMessage.unpack_hdr(hdr)
-        if err is not None:
-            raise Exception(f'unpacking header failed: {err}')
-        
-        data= self._recv_all(length)
-        if data is None:
-            raise Exception('failed to recv response data')
-
-        if msg_type == MsgTypes.Output:
-            msg= Output.deserialize(data)
-            return msg.data, False
-        elif msg_type == MsgTypes.Error:
-            msg= Error.deserialize(data)
-            return msg.data, True
-        elif msg_type == MsgTypes.FunctionErr:
-            msg= FunctionErr.deserialize(data)
-            raise Exception(f"err from server: {msg.data}")
+        if msg.type in (MsgTypes.Output, MsgTypes.Stream, MsgTypes.StreamEnd):
+            return bytes(msg.data), False
+        elif msg.type == MsgTypes.Error:
+            return bytes(msg.data), True
         else:
-            raise Exception(f"bad message type from server")
+            raise Exception(f"err from server: {bytes(msg.data)}")
+
+
+    def iter_output(self, function_id):
+        """
+        iterate over the output of an open function until its stream ends or it terminates
+            - chunks are memoryviews into the receive buffer, so memory use stays bounded by the
+              chunk size however large the output is
+            - raise an exception on a function error or a server error
+        """
+        while True:
+            msg= self.recv_message(function_id)
+            if msg.type in (MsgTypes.Output, MsgTypes.Stream):
+                if len(msg.data):
+                    yield msg.data
+            elif msg.type == MsgTypes.StreamEnd:
+                return
+            elif msg.type == MsgTypes.Error:
+                raise Exception(f"err from function: {bytes(msg.data)}")
+            elif bytes(msg.data) == b"function dead":
+                return
+            else:
+                raise Exception(f"err from server: {bytes(msg.data)}")
+
+
+    def readinto(self, function_id, buffer):
+        """
+        read the output of an open function into buffer like a raw file
+            - return the number of bytes read, 0 once its stream ended or it terminated
+        """
+        view= memoryview(buffer).cast('B')
+        if function_id not in self.readers:
+            self.readers[function_id]= [self.iter_output(function_id), memoryview(b'')]
+        reader= self.readers[function_id]
+
+        while not reader[1]:
+            if reader[0] is None:
+                return 0
+            reader[1]= next(reader[0], None)
+            if reader[1] is None:
+                reader[:]= [None, memoryview(b'')]
+
+        n= min(len(view), len(reader[1]))
+        view[:n]= reader[1][:n]
+        reader[1]= reader[1][n:]
+        return n
+
+
+    def recv_message(self, function_id=None):
+        """
+        get the next message from any open instance, or from the one with the given function_id
+            - return the Output, Error or FunctionErr message, messages of other instances are
+              kept until they are asked for
+            - the message data is a memoryview into the receive buffer
+        """
+        for msg in self.pending:
+            if function_id is None or msg.function_id == function_id:
+                self.pending.remove(msg)
+                return self._consume(msg)
+
+        while True:
+            frame= self._recv_frame()
+            if isinstance(frame, Response):
+                errmsg= frame.errmsg if not frame.success else "unexpected response"
+                raise Exception(f"err from server: {errmsg}")
+            if function_id is None or frame.function_id == function_id:
+                return self._consume(frame)
+            self.pending.append(frame)
 
        
+    def buffered(self):
+        """
+        return whether messages or data were received but not read yet, select won't report the
+        connection readable for them
+        """
+        return bool(self.pending) or self.recvbuff.buffered()
+
+
+    def close(self):
+        """
+        close the connection to the server
+        """
+        self.conn.close()
+
+
+    def _consume(self, msg):
+        """
+        account for a message being read, granting credit again once half the window was read
+        """
+        if msg.type == MsgTypes.FunctionErr:
+            self.consumed.pop(msg.function_id, None)
+        elif msg.function_id in self.consumed:
+            consumed= self.consumed[msg.function_id] + len(msg.data)
+            if consumed >= self.window // 2:
+                self.grant_credit(msg.function_id, consumed)
+                consumed= 0
+            self.consumed[msg.function_id]= consumed
+        return msg
+
+
     def _send_request(self, request):
         """
         send wrapper
         """
-        self.conn.sendall(request.serialize())
+        send_buffers(self.conn, request.buffers(self.version))
 
 
     def _get_response(self):        
         """
         attempt to receive response data 
+            - messages from open instances that arrive first are kept for recv_message
+        """
+        while True:
+            frame= self._recv_frame()
+            if isinstance(frame, Response):
+                return frame
+            self.pending.append(frame)
+
+
+    def _recv_frame(self):
+        """
+        recv the next response or function message, told apart by the first byte of the header
         """
-        hdr= self._recv_all(Response.HeaderLen)
+        first= self.recvbuff.peek(1)
+        if first is None:
+            raise Exception("failed to recv header")
+
+        if Request.versioned(first) or FunctionMessage.split_type(first[0])[0] not in _messages:
+            return self._recv_response(first)
+
+        hdr= self.recvbuff.read(FunctionMessage.HeaderLen)
         if hdr is None:
             raise Exception("failed to recv header")
 
-        resp_type, errbyte, length, err= Response.unpack_hdr(hdr)
+        msg_type, length, err= FunctionMessage.unpack_hdr(hdr)
+        if err is not None:
+            raise Exception(f'unpacking header failed: {err}')
+        
+        data= self.recvbuff.read(length)
+        if data is None:
+            raise Exception('failed to recv message data')
+
+        return _parse_message(msg_type, data, self.compressions)
+
+
+    def _recv_response(self, first):
+        """
+        recv a response whose first header byte is first
+        """
+        hdrlen= Response.V2HeaderLen if Request.versioned(first) else Response.HeaderLen
+        hdr= self.recvbuff.read(hdrlen)
+        if hdr is None:
+            raise Exception("failed to recv header")
+
+        version, resp_type, errbyte, length, err= Response.unpack_versioned_hdr(hdr)
         if err is not None:
             raise Exception(f"unpacking header failed: {err}")
 
-        data= self._recv_all(length)
+        data= self.recvbuff.read(length)
         if data is None:
             raise Exception("failed to recv response data")
 
-        if errbyte == 0x0:
-            if resp_type == Types.Execute:
-                return ExecuteResponse.deserialize(data)
-            elif resp_type == Types.Store:
-                return StoreResponse.deserialize(data)
-        else:
-            return ErrorResponse.deserialize(data, resp_type) 
-        
+        return _parse_response(resp_type, errbyte, data)
+
+
+class AsyncClientConnection:
+    """
+    asyncio counterpart of ClientConnection so a single event loop can drive many sessions
+        - requests are awaitable and the output of an open instance is consumed with
+          `async for data, err in conn.output(function_id)`
+        - create connections with `await AsyncClientConnection.connect(address, port)`
+        - window: as for ClientConnection, credit is granted again as output() is iterated
+        - compress: as for ClientConnection
+    """
+
+    def __init__(self, reader, writer, version: int=Versions.Latest, window: int=None,
+                 compress: bool=False):
+        self.reader= reader
+        self.writer= writer
+        self.version= version
+        self.window= window
+        self.consumed= {}
+        self.compress= compress and version != Versions.V1
+        self.compressions= {}
+        self.requests= deque()
+        self.outputs= {}
+        self.closed= None
+        self.reader_task= asyncio.ensure_future(self._recv_frames())
+
+
+    @classmethod
+    async def connect(cls, address: str, port: int, version: int=Versions.Latest,
+                      window: int=None, compress: bool=False):
+        reader, writer= await asyncio.open_connection(address, port)
+        return cls(reader, writer, version, window, compress)
+
+
+    async def send_store_request(self, name, code):
+        """
+        send a store request and wait for the store response or error from the server
+        """
+        response= await self._request(Types.Store, StoreRequest(name, code))
+        if response.resp_type != Types.Store:
+            raise Exception("Request-Response types don't match")
+        return (response.token, None) if response.success == True else (None, response.errmsg)
+
+
+    async def send_execute_request(self, call, token):
+        """
+        send an execute request and wait for the execute response or error from the server
+        """
+        response= await self._request(Types.Execute, ExecuteRequest(call, token))
+        if response.resp_type != Types.Execute:
+            raise Exception("Request-Response types don't match")
+        return (response.function_id, None) if response.success == True else (None, response.errmsg)
+
+
+    async def send_metrics_request(self):
+        """
+        request the server's metrics in the prometheus text format
+        """
+        response= await self._request(Types.Metrics, MetricsRequest())
+        if response.resp_type != Types.Metrics:
+            raise Exception("Request-Response types don't match")
+        return (response.text, None) if response.success == True else (None, response.errmsg)
+
+
+    async def send_open_request(self, function_id):
+        """
+        start exchanging data with a function, its output is then available from output()
+            - no response expected, an error is raised from output() instead
+        """
+        self.outputs.setdefault(function_id, asyncio.Queue())
+        # v2 servers report a failed open as a FunctionErr of the instance
+        if self.version == Versions.V1:
+            self.requests.append((Types.Open, function_id))
+        flags= 0
+        if self.compress:
+            flags|= OpenRequest.Compress
+            self.compressions.setdefault(function_id, Compression())
+        window= None
+        if self.window:
+            self.consumed[function_id]= 0
+            # v1 open requests can't carry the window, the server keeps credit granted ahead
+            if self.version == Versions.V1:
+                await self.grant_credit(function_id, self.window)
+            else:
+                window= self.window
+        await self._send(OpenRequest(function_id, flags, window).serialize(self.version))
+
+
+    async def send_close_request(self, function_id):
+        """
+        stop exchanging data with a function
+            - no response expected, output sent before the server got the request may still arrive
+        """
+        await self._send(CloseRequest(function_id).serialize(self.version))
+        self.consumed.pop(function_id, None)
+
+
+    async def grant_credit(self, function_id, amount):
+        """
+        let an open function send amount more bytes of output
+        """
+        await self._send(*Credit(function_id, amount).buffers())
+
+
+    async def send_input(self, function_id, data):
+        """
+        send data to an executing function assuming communication with the function is open
+        """
+        if len(data) == 0:
+            return 0
+
+        if isinstance(data, str):
+            data= data.encode()
+        msg= Input(function_id, data)
+        if function_id in self.compressions:
+            msg= self.compressions[function_id].compress(msg)
+        await self._send(*msg.buffers())
+        return len(data)
+
+
+    async def output(self, function_id):
+        """
+        iterate over (data, is_stderr) output of an open function until its stream ends or it
+        terminates
+            - raise an exception on a server error
+        """
+        queue= self.outputs.setdefault(function_id, asyncio.Queue())
+        while True:
+            msg= await queue.get()
+            if isinstance(msg, Exception):
+                self.outputs.pop(function_id, None)
+                raise msg
+            await self._consume(msg)
+            if msg.type in (MsgTypes.Output, MsgTypes.Stream):
+                yield msg.data, False
+            elif msg.type == MsgTypes.Error:
+                yield msg.data, True
+            elif msg.type == MsgTypes.StreamEnd:
+                self.outputs.pop(function_id, None)
+                return
+            else:
+                self.outputs.pop(function_id, None)
+                if bytes(msg.data) == b"function dead":
+                    return
+                raise Exception(f"err from server: {bytes(msg.data).decode(errors='replace')}")
+
+
+    async def close(self):
+        """
+        close the connection to the server
+        """
+        self.writer.close()
+        self.reader_task.cancel()
+        self._fail(ConnectionError("connection closed"))
+
+
+    async def _request(self, req_type, request):
+        """
+        send a request and wait for its response
+            - the server answers requests in order, so responses are matched to the oldest request
+        """
+        future= asyncio.get_event_loop().create_future()
+        self.requests.append((req_type, future))
+        await self._send(request.serialize(self.version))
+        return await future
+
+
+    async def _consume(self, msg):
+        """
+        account for a message being read, granting credit again once half the window was read
+        """
+        if msg.type == MsgTypes.FunctionErr:
+            self.consumed.pop(msg.function_id, None)
+        elif msg.function_id in self.consumed:
+            consumed= self.consumed[msg.function_id] + len(msg.data)
+            if consumed >= self.window // 2:
+                await self.grant_credit(msg.function_id, consumed)
+                consumed= 0
+            self.consumed[msg.function_id]= consumed
+
+
+    async def _send(self, *buffers):
+        if self.closed is not None:
+            raise self.closed
+        self.writer.writelines(buffers)
+        await self.writer.drain()
+
+
+    async def _recv_frames(self):
+        """
+        dispatch responses to waiting requests and function messages to their output queues
+        """
+        try:
+            while True:
+                hdr= await self.reader.readexactly(FunctionMessage.HeaderLen)
+
+                if Request.versioned(hdr) or FunctionMessage.split_type(hdr[0])[0] not in _messages:
+                    hdrlen= Response.V2HeaderLen if Request.versioned(hdr) else Response.HeaderLen
+                    hdr+= await self.reader.readexactly(hdrlen - len(hdr))
+                    version, resp_type, errbyte, length, err= Response.unpack_versioned_hdr(hdr)
+                    if err is not None:
+                        raise Exception(f"unpacking header failed: {err}")
+                    data= await self.reader.readexactly(length)
+                    self._dispatch_response(_parse_response(resp_type, errbyte, data))
+                    continue
+
+                msg_type, length, err= FunctionMessage.unpack_hdr(hdr)
+                if err is not None:
+                    raise Exception(f"unpacking header failed: {err}")
+                data= await self.reader.readexactly(length)
+                msg= _parse_message(msg_type, data, self.compressions)
+                self.outputs.setdefault(msg.function_id, asyncio.Queue()).put_nowait(msg)
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            self._fail(exc if not isinstance(exc, asyncio.IncompleteReadError)
+                       else ConnectionError("connection closed by server"))
+
+
+    def _dispatch_response(self, response):
+        """
+        hand a response to the request it answers
+            - a v1 open request only gets a response if it failed, so opens that precede the
+              request a response is for succeeded, and a failed open is the pending open whose
+              function_id the error names, or the oldest one if it names none
+        """
+        if response.resp_type == Types.Open:
+            opens= list(takewhile(lambda request: request[0] == Types.Open, self.requests))
+            if not opens:
+                return
+            failed= next((i for i, (_, function_id) in enumerate(opens)
+                          if function_id in response.errmsg), 0)
+            for _ in range(failed + 1):
+                _, function_id= self.requests.popleft()
+            queue= self.outputs.get(function_id)
+            if queue:
+                queue.put_nowait(Exception(f"err from server: {response.errmsg}"))
+            return
+
+        while self.requests:
+            req_type, waiter= self.requests.popleft()
+            if req_type == Types.Open:
+                continue
+            if not waiter.done():
+                waiter.set_result(response)
+            return
+
 
-    def _recv_all(self, n):
+    def _fail(self, exc):
         """
-        recv wrapper
+        fail every pending request and output with the given exception
         """
-        data = bytearray()
-        while len(data) < n:
-            packet= self.conn.recv(n - len(data))
-            if not packet:
-                return None
-            data.extend(packet)
-        return data
+        if self.closed is not None:
+            return
+        self.closed= exc
+        while self.requests:
+            req_type, waiter= self.requests.popleft()
+            if req_type != Types.Open and not waiter.done():
+                waiter.set_exception(exc)
+        for queue in self.outputs.values():
+            queue.put_nowait(exc)
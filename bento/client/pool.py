@@ -0,0 +1,152 @@
+"""
+Pool of warm connections to a bento server
+"""
+
+from contextlib import contextmanager
+import logging
+import socket
+from threading import Condition, Thread
+import time
+
+from bento.client.api import ClientConnection
+from bento.common.protocol import Versions
+
+
+class ClientPool:
+    """
+    keeps idle connections to a Bento server open so callers never connect on the critical path
+        - size: number of idle connections the pool refills to in the background
+        - max_idle: number of returned connections kept for reuse, extra ones are closed
+        - connections are health checked when handed out and returned and periodically while
+          idle, dead ones are replaced
+    """
+
+    """ seconds between health checks of idle connections """
+    CheckInterval= 5
+
+    def __init__(self, address: str, port: int, size: int=4, max_idle: int=None,
+                 version: int=Versions.Latest):
+        self.address= address
+        self.port= port
+        self.size= size
+        self.max_idle= size if max_idle is None else max_idle
+        self.version= version
+        self.idle= []
+        self.cond= Condition()
+        self.running= True
+        self.thread= Thread(target=self._refill, name='client-pool', daemon=True)
+        self.thread.start()
+
+
+    def acquire(self) -> ClientConnection:
+        """
+        hand out a healthy idle connection, connecting right away only if none is idle
+        """
+        with self.cond:
+            while self.idle:
+                conn= self.idle.pop()
+                self.cond.notify()
+                if _healthy(conn):
+                    return conn
+                conn.close()
+            self.cond.notify()
+        return self._connect()
+
+
+    def release(self, conn: ClientConnection):
+        """
+        return a connection for reuse
+            - the caller must have closed or finished every instance it opened on the connection,
+              connections with unread data are closed instead of reused
+        """
+        with self.cond:
+            if self.running and len(self.idle) < self.max_idle and _healthy(conn):
+                self.idle.append(conn)
+                return
+        conn.close()
+
+
+    def discard(self, conn: ClientConnection):
+        """
+        close a connection that is not fit for reuse, the pool replaces it in the background
+        """
+        conn.close()
+        with self.cond:
+            self.cond.notify()
+
+
+    @contextmanager
+    def connection(self):
+        """
+        acquire a connection for the duration of a with block, discarding it on error
+        """
+        conn= self.acquire()
+        try:
+            yield conn
+        except Exception:
+            self.discard(conn)
+            raise
+        self.release(conn)
+
+
+    def close(self):
+        """
+        stop refilling and close every idle connection
+        """
+        with self.cond:
+            self.running= False
+            idle, self.idle= self.idle, []
+            self.cond.notify_all()
+        for conn in idle:
+            conn.close()
+
+
+    def _connect(self):
+        return ClientConnection(self.address, self.port, self.version)
+
+
+    def _refill(self):
+        """
+        drop dead idle connections and open new ones until size are idle
+        """
+        while True:
+            with self.cond:
+                if self.running and len(self.idle) >= self.size:
+                    self.cond.wait(ClientPool.CheckInterval)
+                if not self.running:
+                    return
+                dead= [conn for conn in self.idle if not _healthy(conn)]
+                self.idle= [conn for conn in self.idle if conn not in dead]
+                missing= self.size - len(self.idle)
+
+            for conn in dead:
+                conn.close()
+
+            for _ in range(missing):
+                try:
+                    conn= self._connect()
+                except OSError as exc:
+                    logging.error(f"client pool failed to connect: {exc}")
+                    time.sleep(1)
+                    break
+                with self.cond:
+                    if not self.running:
+                        conn.close()
+                        return
+                    self.idle.append(conn)
+
+
+def _healthy(conn: ClientConnection):
+    """
+    return whether a connection is open and has nothing left unread from a previous user
+    """
+    if conn.buffered():
+        return False
+    try:
+        conn.conn.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    # either closed by the server or stale data is waiting
+    return False
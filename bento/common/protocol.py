@@ -4,6 +4,8 @@ Application Protocol
 
 import struct
 import json
+import socket
+import zlib
 
 
 """
@@ -16,6 +18,43 @@ class Types:
     Execute = 0x1
     Open    = 0x2
     Close   = 0x3
+    # after MsgTypes so v1 responses are not mistaken for function messages
+    Metrics = 0xb
+
+
+class Versions:
+    """
+    protocol versions of requests and responses
+        - V1: json request bodies, the header has no version byte
+        - V2: length-prefixed binary request bodies, the header starts with a byte that has
+              VersionFlag set and holds the version, followed by the v1 header
+        - the server answers a request in the version it was sent with
+    """
+    V1= 1
+    V2= 2
+    Latest= V2
+    Supported= (V1, V2)
+
+VersionFlag= 0x80
+
+
+""" two length-prefixed fields: [len a][len b][a][b] """
+_Fields= struct.Struct('>II')
+
+def _pack_fields(first: bytes, second: bytes):
+    return b''.join(_field_buffers(first, second))
+
+def _field_buffers(first: bytes, second: bytes):
+    return [_Fields.pack(len(first), len(second)), first, second]
+
+def _decode(data):
+    """ decode bytes, a bytearray or a memoryview into a str """
+    return str(data, 'utf-8')
+
+def _unpack_fields(data):
+    first_len, second_len= _Fields.unpack_from(data)
+    pos= _Fields.size
+    return data[pos:pos + first_len], data[pos + first_len:pos + first_len + second_len]
 
 
 class Request:
@@ -26,26 +65,67 @@ class Request:
     """ header properties """
     HeaderLen= 5
     HeaderFmt= '>BI'
+    V2HeaderLen= 6
+    V2HeaderFmt= '>BBI'
+
+    Header= struct.Struct(HeaderFmt)
+    V2Header= struct.Struct(V2HeaderFmt)
 
     @staticmethod
     def unpack_hdr(packed_hdr):
         if Request.HeaderLen != len(packed_hdr):
             return None, None, "header len doesn't match"
 
-        req_type, length= struct.unpack(Request.HeaderFmt, packed_hdr)
+        req_type, length= Request.Header.unpack(packed_hdr)
 
         return req_type, length, None
 
+    @staticmethod
+    def versioned(packed_hdr):
+        """
+        return whether the first byte of a header announces a v2 (or later) header, in which
+        case V2HeaderLen bytes have to be read instead of HeaderLen
+        """
+        return bool(packed_hdr[0] & VersionFlag)
+
+    @staticmethod
+    def unpack_versioned_hdr(packed_hdr):
+        """
+        unpack a header of any version into its version, type and length
+        """
+        if not Request.versioned(packed_hdr):
+            req_type, length, err= Request.unpack_hdr(packed_hdr)
+            return Versions.V1, req_type, length, err
+
+        if Request.V2HeaderLen != len(packed_hdr):
+            return None, None, None, "header len doesn't match"
+
+        version, req_type, length= Request.V2Header.unpack(packed_hdr)
+
+        return version & ~VersionFlag, req_type, length, None
+
+    @staticmethod
+    def pack_hdr(req_type, length, version):
+        if version == Versions.V1:
+            return Request.Header.pack(req_type, length)
+        return Request.V2Header.pack(VersionFlag | version, req_type, length)
+
 
     """ inherited functions """
-    def serialize(self) -> bytes:
+    def serialize(self, version=Versions.V1) -> bytes:
         """
         serialize the Request object into a byte buffer to send over the network
         """
         pass
 
+    def buffers(self, version=Versions.V1) -> list:
+        """
+        the serialized Request as a list of buffers that are sent back to back with sendmsg
+        """
+        return [self.serialize(version)]
+
     @classmethod
-    def deserialize(cls, data: bytes):
+    def deserialize(cls, data: bytes, version=Versions.V1):
         """
         deserialize a byte buffer into a Request object
         """
@@ -57,19 +137,25 @@ class StoreRequest(Request):
         self.name= name
         self.code= code
 
-    def serialize(self):
-        data= json.dumps({'name': self.name, 'code': self.code})
-        bdata= str(data).encode()
-        header= struct.pack(Request.HeaderFmt, 
-                            Types.Store, 
-                            len(data))
-        return header + bdata
+    def serialize(self, version=Versions.V1):
+        return b''.join(self.buffers(version))
+
+    def buffers(self, version=Versions.V1):
+        if version == Versions.V1:
+            fields= [json.dumps({'name': self.name, 'code': self.code}).encode()]
+        else:
+            fields= _field_buffers(self.name.encode(), self.code.encode())
+        length= sum(len(field) for field in fields)
+        return [Request.pack_hdr(Types.Store, length, version)] + fields
 
     @classmethod
-    def deserialize(cls, data):
-        jdata= json.loads(data.decode())
-        return cls(name= jdata.get('name'), 
-                   code= jdata.get('code'))
+    def deserialize(cls, data, version=Versions.V1):
+        if version == Versions.V1:
+            jdata= json.loads(_decode(data))
+            return cls(name= jdata.get('name'), 
+                       code= jdata.get('code'))
+        name, code= _unpack_fields(data)
+        return cls(name= _decode(name), code= _decode(code))
 
 
 class ExecuteRequest(Request):
@@ -77,46 +163,82 @@ class ExecuteRequest(Request):
         self.call= call
         self.token= token
 
-    def serialize(self):
-        data= json.dumps({'call': self.call, 'token': self.token})
-        bdata= str(data).encode()
-        header= struct.pack(Request.HeaderFmt, 
-                            Types.Execute, 
-                            len(data))
-        return header + bdata
+    def serialize(self, version=Versions.V1):
+        if version == Versions.V1:
+            bdata= json.dumps({'call': self.call, 'token': self.token}).encode()
+        else:
+            bdata= _pack_fields(self.call.encode(), self.token.encode())
+        return Request.pack_hdr(Types.Execute, len(bdata), version) + bdata
 
     @classmethod
-    def deserialize(cls, data):
-        jdata= json.loads(data.decode())
-        return cls(call= jdata.get('call'), token= jdata.get('token'))
+    def deserialize(cls, data, version=Versions.V1):
+        if version == Versions.V1:
+            jdata= json.loads(_decode(data))
+            return cls(call= jdata.get('call'), token= jdata.get('token'))
+        call, token= _unpack_fields(data)
+        return cls(call= _decode(call), token= _decode(token))
 
 
 class OpenRequest(Request):
-    def __init__(self, function_id: str):
-        self.function_id= function_id
+    """
+    v2 open requests may carry a flags byte after the function_id
+        - Compress: compress messages of the session, see Compression
+        - Window: the flags byte is followed by the initial credit of the session, so no output
+          is sent beyond it before a Credit message could arrive
+    """
+    Compress= 0x1
+    Window= 0x2
 
-    def serialize(self):
-        function_id= self.function_id.encode()
-        header= struct.pack(Request.HeaderFmt, Types.Open, len(function_id))
-        return header + function_id
+    WindowFmt= struct.Struct('>I')
+
+    def __init__(self, function_id: str, flags: int=0, window: int=None):
+        self.function_id= function_id
+        self.flags= flags
+        self.window= window
+
+    def serialize(self, version=Versions.V1):
+        bdata= self.function_id.encode()
+        flags= self.flags | (OpenRequest.Window if self.window is not None else 0)
+        if version != Versions.V1 and flags:
+            bdata+= bytes([flags])
+            if flags & OpenRequest.Window:
+                bdata+= OpenRequest.WindowFmt.pack(self.window)
+        return Request.pack_hdr(Types.Open, len(bdata), version) + bdata
     
     @classmethod
-    def deserialize(cls, data):
-        return cls(function_id= data.decode())
+    def deserialize(cls, data, version=Versions.V1):
+        if version == Versions.V1 or len(data) <= function_id_len:
+            return cls(function_id= _decode(data))
+        flags= data[function_id_len]
+        window= None
+        if flags & OpenRequest.Window:
+            window,= OpenRequest.WindowFmt.unpack_from(data, function_id_len + 1)
+        return cls(function_id= _decode(data[:function_id_len]), flags= flags, window= window)
 
 
 class CloseRequest(Request):
     def __init__(self, function_id: str):
         self.function_id= function_id
 
-    def serialize(self):
+    def serialize(self, version=Versions.V1):
         function_id= self.function_id.encode()
-        header= struct.pack(Request.HeaderFmt, Types.Close, len(function_id))
-        return header + function_id 
+        return Request.pack_hdr(Types.Close, len(function_id), version) + function_id 
 
     @classmethod
-    def deserialize(cls, data):
-        return cls(function_id= data.decode())
+    def deserialize(cls, data, version=Versions.V1):
+        return cls(function_id= _decode(data))
+
+
+class MetricsRequest(Request):
+    """
+    admin request for the server's metrics, it has no body
+    """
+    def serialize(self, version=Versions.V1):
+        return Request.pack_hdr(Types.Metrics, 0, version)
+
+    @classmethod
+    def deserialize(cls, data, version=Versions.V1):
+        return cls()
 
 
 class Response:
@@ -128,22 +250,56 @@ class Response:
     """ header properties """
     HeaderLen= 6
     HeaderFmt= '>BBI'
+    V2HeaderLen= 7
+    V2HeaderFmt= '>BBBI'
+
+    Header= struct.Struct(HeaderFmt)
+    V2Header= struct.Struct(V2HeaderFmt)
 
     @staticmethod
     def unpack_hdr(packed_hdr):
         if Response.HeaderLen != len(packed_hdr):
             return None, None, None, "header len doesn't match"
 
-        resp_type, error, length= struct.unpack(Response.HeaderFmt, packed_hdr)
+        resp_type, error, length= Response.Header.unpack(packed_hdr)
 
         return resp_type, error, length, None
 
-    def serialize(self) -> bytes:
+    @staticmethod
+    def unpack_versioned_hdr(packed_hdr):
+        """
+        unpack a header of any version into its version, type, error byte and length
+            - as with requests, Request.versioned() tells whether V2HeaderLen bytes are needed
+        """
+        if not Request.versioned(packed_hdr):
+            resp_type, error, length, err= Response.unpack_hdr(packed_hdr)
+            return Versions.V1, resp_type, error, length, err
+
+        if Response.V2HeaderLen != len(packed_hdr):
+            return None, None, None, None, "header len doesn't match"
+
+        version, resp_type, error, length= Response.V2Header.unpack(packed_hdr)
+
+        return version & ~VersionFlag, resp_type, error, length, None
+
+    @staticmethod
+    def pack_hdr(resp_type, error, length, version):
+        if version == Versions.V1:
+            return Response.Header.pack(resp_type, error, length)
+        return Response.V2Header.pack(VersionFlag | version, resp_type, error, length)
+
+    def serialize(self, version=Versions.V1) -> bytes:
         """
         serialize the Response object into a byte buffer to send over the network
         """
         pass
 
+    def buffers(self, version=Versions.V1) -> list:
+        """
+        the serialized Response as a list of buffers that are sent back to back with sendmsg
+        """
+        return [self.serialize(version)]
+
     def deserialize(data: bytes):
         """
         deserialize a byte buffer into a Request object
@@ -157,17 +313,13 @@ class StoreResponse(Response):
         self.resp_type= Types.Store
         self.success= True
 
-    def serialize(self):
+    def serialize(self, version=Versions.V1):
         bdata= str(self.token).encode()
-        header= struct.pack(Response.HeaderFmt, 
-                            Types.Store,
-                            Response.Success, 
-                            len(bdata))
-        return header + bdata
+        return Response.pack_hdr(Types.Store, Response.Success, len(bdata), version) + bdata
 
     @classmethod
     def deserialize(cls, data):
-        return cls(token= data.decode())
+        return cls(token= _decode(data))
 
 
 class ExecuteResponse(Response):
@@ -176,17 +328,31 @@ class ExecuteResponse(Response):
         self.resp_type= Types.Execute
         self.success= True
 
-    def serialize(self):
+    def serialize(self, version=Versions.V1):
         bdata= str(self.function_id).encode()
-        header= struct.pack(Response.HeaderFmt, 
-                            Types.Execute,
-                            Response.Success, 
-                            len(bdata))
-        return header + bdata
+        return Response.pack_hdr(Types.Execute, Response.Success, len(bdata), version) + bdata
+
+    @classmethod
+    def deserialize(cls, data):
+        return cls(function_id= _decode(data))
+
+
+class MetricsResponse(Response):
+    """
+    the server's metrics in the prometheus text format
+    """
+    def __init__(self, text: str):
+        self.text= text
+        self.resp_type= Types.Metrics
+        self.success= True
+
+    def serialize(self, version=Versions.V1):
+        bdata= self.text.encode()
+        return Response.pack_hdr(Types.Metrics, Response.Success, len(bdata), version) + bdata
 
     @classmethod
     def deserialize(cls, data):
-        return cls(function_id= data.decode())
+        return cls(text= _decode(data))
 
 
 class ErrorResponse(Response):
@@ -195,17 +361,13 @@ class ErrorResponse(Response):
         self.errmsg= errmsg
         self.success= False
 
-    def serialize(self):
+    def serialize(self, version=Versions.V1):
         bdata= str(self.errmsg).encode()
-        header= struct.pack(Response.HeaderFmt,
-                            self.resp_type,
-                            Response.Error, 
-                            len(bdata))
-        return header + bdata
+        return Response.pack_hdr(self.resp_type, Response.Error, len(bdata), version) + bdata
 
     @classmethod
     def deserialize(cls, data, resp_type):
-        return cls(errmsg= data.decode(), resp_type= resp_type)
+        return cls(errmsg= _decode(data), resp_type= resp_type)
 
 
 """
@@ -218,6 +380,9 @@ class MsgTypes:
     Error       = 0x5
     Output      = 0x6
     Input       = 0x7
+    Stream      = 0x8
+    StreamEnd   = 0x9
+    Credit      = 0xa
 
 function_id_len= 36   
 
@@ -228,22 +393,40 @@ class FunctionMessage():
     HeaderFmt= '>BI'
     HeaderLen= 5
 
+    Header= struct.Struct(HeaderFmt)
+
+    """ set in the type byte of a message whose data is compressed """
+    CompressedFlag= 0x40
+
     def __init__(self, function_id: str, data):
         self.function_id= function_id
         if isinstance(data, str):
             data= data.encode()
+        elif isinstance(data, memoryview):
+            data= data.cast('B')
         self.data= data
         self.type= None
+        self.compressed= False
 
-    def serialize(self):
+    def serialize(self, version=None):
+        """
+        function messages have the same layout in every protocol version
+        """
+        return b''.join(self.buffers(version))
+
+    def buffers(self, version=None):
+        """
+        header and function_id in one buffer and the data, which is never copied, in another
+        """
         function_id= self.function_id.encode()
         pkt_len= len(function_id) + len(self.data)
-        header= struct.pack(FunctionMessage.HeaderFmt, self.type, pkt_len)
-        return header + function_id + self.data
+        msg_type= self.type | FunctionMessage.CompressedFlag if self.compressed else self.type
+        header= FunctionMessage.Header.pack(msg_type, pkt_len)
+        return [header + function_id, self.data]
     
     @classmethod
     def deserialize(cls, data):
-        function_id= data[:function_id_len].decode()
+        function_id= _decode(data[:function_id_len])
         data= data[function_id_len:]
         return cls(function_id= function_id, data= data)
 
@@ -252,10 +435,17 @@ class FunctionMessage():
         if FunctionMessage.HeaderLen != len(packed_hdr):
             return None, None, "header len doesn't match"
 
-        msg_type, length= struct.unpack(FunctionMessage.HeaderFmt, packed_hdr)
+        msg_type, length= FunctionMessage.Header.unpack(packed_hdr)
 
         return msg_type, length, None
 
+    @staticmethod
+    def split_type(msg_type):
+        """
+        split a type byte into the message type and whether the message data is compressed
+        """
+        return msg_type & ~FunctionMessage.CompressedFlag, bool(msg_type & FunctionMessage.CompressedFlag)
+
 
 class Error(FunctionMessage):
     """
@@ -292,4 +482,198 @@ class FunctionErr(FunctionMessage):
         super().__init__(function_id, data)
         self.type= MsgTypes.FunctionErr
 
-      
\ No newline at end of file
+
+class Stream(FunctionMessage):
+    """
+    sent from a function as a chunk of streamed output
+    """
+    def __init__(self, function_id: str, data: bytes):
+        super().__init__(function_id, data)
+        self.type= MsgTypes.Stream
+
+
+class StreamEnd(FunctionMessage):
+    """
+    sent from a function to mark the end of its streamed output
+    """
+    def __init__(self, function_id: str, data: bytes=b''):
+        super().__init__(function_id, data)
+        self.type= MsgTypes.StreamEnd
+
+
+class Credit(FunctionMessage):
+    """
+    sent from a client to let a function send amount more bytes of output
+        - once a client granted credit for an instance the server only sends its output while
+          there is credit left, without any grant output is not flow controlled
+    """
+    Amount= struct.Struct('>I')
+
+    def __init__(self, function_id: str, data):
+        if isinstance(data, int):
+            data= Credit.Amount.pack(data)
+        super().__init__(function_id, data)
+        self.type= MsgTypes.Credit
+
+    @property
+    def amount(self):
+        return Credit.Amount.unpack(self.data)[0]
+
+      
+
+
+
+class Compression:
+    """
+    streaming zlib compression of the messages of one session, requested with the Compress flag
+    of an open request
+        - each side compresses the data of the messages it sends with one compressobj and
+          decompresses the messages it receives with one decompressobj, so later messages
+          reuse the history of earlier ones
+        - only data of at least threshold bytes is compressed and CompressedFlag marks those
+          messages, a threshold of None turns compressing off while still decompressing
+        - messages have to be decompressed in the order they arrived
+    """
+    Threshold= 256
+    Level= 6
+
+    def __init__(self, threshold: int=Threshold, level: int=Level):
+        self.threshold= threshold
+        self.compressor= zlib.compressobj(level)
+        self.decompressor= zlib.decompressobj()
+
+
+    def compress(self, msg: FunctionMessage) -> FunctionMessage:
+        """
+        return a compressed copy of a message, or the message itself if it is too small
+        """
+        if self.threshold is None or len(msg.data) < self.threshold:
+            return msg
+        data= self.compressor.compress(msg.data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        compressed= type(msg)(msg.function_id, data)
+        compressed.compressed= True
+        return compressed
+
+
+    def decompress(self, msg: FunctionMessage) -> FunctionMessage:
+        """
+        decompress the data of a received message in place if it is compressed
+        """
+        if msg.compressed:
+            msg.data= self.decompressor.decompress(msg.data)
+            msg.compressed= False
+        return msg
+
+"""
+============================================================================
+Sending and receiving
+============================================================================
+"""
+""" most buffers a single sendmsg call accepts on linux """
+IovMax= 1024
+
+def send_buffers(sock: socket.socket, buffers):
+    """
+    send a list of buffers back to back with as few sendmsg calls as possible and without
+    joining them, resuming after partial sends like sendall
+    """
+    views= [memoryview(buf).cast('B') for buf in buffers if len(buf)]
+    while views:
+        sent= sock.sendmsg(views[:IovMax])
+        while views and sent >= len(views[0]):
+            sent-= len(views.pop(0))
+        if sent:
+            views[0]= views[0][sent:]
+
+
+class RecvBuffer:
+    """
+    reusable receive buffer of a connection, filled with recv_into so a single syscall picks up
+    as many frames as have arrived
+        - read() hands out memoryviews into the buffer instead of copies, received data is never
+          overwritten so a view stays valid for as long as it is kept
+        - once the buffer is full the unread remainder moves to a new buffer, frames larger than
+          the buffer are received into a buffer of their own size
+    """
+    Size= 65536
+
+    def __init__(self, sock: socket.socket, size: int=Size):
+        self.sock= sock
+        self.size= size
+        self._reset(size)
+
+
+    def read(self, n) -> memoryview:
+        """
+        consume the next n bytes, blocking until they arrived
+            - return None if the connection closed first
+        """
+        view= self.peek(n)
+        if view is not None:
+            self.start+= n
+        return view
+
+
+    def peek(self, n) -> memoryview:
+        """
+        return the next n bytes without consuming them, blocking until they arrived
+            - return None if the connection closed first
+        """
+        if self.end - self.start < n and not self._fill(n):
+            return None
+        return self.view[self.start:self.start + n]
+
+
+    def buffered(self):
+        """
+        return whether received data is waiting to be read, in which case select won't report
+        the connection readable for it
+        """
+        return self.end > self.start
+
+
+    def feed(self, data):
+        """
+        buffer data received by someone else as the next data on the connection
+        """
+        if len(self.buff) - self.end < len(data):
+            unread= self.view[self.start:self.end]
+            self._reset(max(self.size, len(unread) + len(data)))
+            self.buff[:len(unread)]= unread
+            self.end= len(unread)
+        self.buff[self.end:self.end + len(data)]= data
+        self.end+= len(data)
+
+
+    def take(self) -> bytes:
+        """
+        consume and return everything buffered, e.g. to hand the connection to someone else
+        """
+        data= bytes(self.view[self.start:self.end])
+        self.start= self.end
+        return data
+
+
+    def _fill(self, n):
+        """
+        recv until at least n unread bytes are buffered, return whether they arrived
+        """
+        if len(self.buff) - self.start < n:
+            unread= self.view[self.start:self.end]
+            self._reset(max(self.size, n))
+            self.buff[:len(unread)]= unread
+            self.end= len(unread)
+
+        while self.end - self.start < n:
+            received= self.sock.recv_into(self.view[self.end:])
+            if not received:
+                return False
+            self.end+= received
+        return True
+
+
+    def _reset(self, size):
+        self.buff= bytearray(size)
+        self.view= memoryview(self.buff)
+        self.start= 0
+        self.end= 0
@@ -0,0 +1,174 @@
+"""
+Admission control for instance creation
+"""
+
+from collections import deque
+from threading import Condition
+import time
+
+
+class AdmissionError(Exception):
+    """
+    an execute request was turned away, the message says why
+    """
+    pass
+
+
+class Ticket:
+    """
+    a place in the wait queue and, once admitted, a running instance slot
+        - state is 'queued' until the ticket is 'admitted' or 'shed'
+    """
+    def __init__(self, client, token):
+        self.client= client
+        self.token= token
+        self.queued_at= time.monotonic()
+        self.instance= None
+        self.state= 'queued'
+
+
+class Admission:
+    """
+    decides when an execute request may start an instance
+        - max_instances caps the instances running at once, max_per_client and max_per_token cap
+          them per client address and per function token, 0 means no cap
+        - requests over a cap wait in a queue of at most queue_size tickets and are shed once
+          they waited max_wait seconds
+        - a slot is held from admission until the instance's process exits, slots of exited
+          instances are reclaimed whenever the queue is checked
+        - a ticket is admitted when it fits the caps and no ticket queued before it does
+    """
+
+    """ seconds between checks of a waiting ticket """
+    PollInterval= 0.05
+
+    def __init__(self, max_instances: int=0, max_per_client: int=0, max_per_token: int=0,
+                 queue_size: int=0, max_wait: float=0):
+        self.max_instances= max_instances
+        self.max_per_client= max_per_client
+        self.max_per_token= max_per_token
+        self.queue_size= queue_size
+        self.max_wait= max_wait
+        self.running= []
+        self.queue= deque()
+        self.cond= Condition()
+        self.stats= {'admitted': 0, 'queued': 0, 'rejected': 0, 'shed': 0}
+
+
+    def acquire(self, client, token) -> Ticket:
+        """
+        block until a ticket for client and token is admitted
+            - raise AdmissionError if the queue is full or the ticket waited too long
+        """
+        ticket= self.enqueue(client, token)
+        with self.cond:
+            while not self._poll(ticket):
+                self.cond.wait(Admission.PollInterval)
+        return ticket
+
+
+    def enqueue(self, client, token) -> Ticket:
+        """
+        queue a ticket for client and token, poll() tells when it is admitted
+            - raise AdmissionError if the queue is full
+        """
+        ticket= Ticket(client, token)
+        with self.cond:
+            if not self.queue and self._fits(ticket):
+                self._admit(ticket)
+                return ticket
+            if len(self.queue) >= self.queue_size:
+                self.stats['rejected']+= 1
+                raise AdmissionError(f"too many instances, {len(self.queue)} requests waiting")
+            self.queue.append(ticket)
+            self.stats['queued']+= 1
+        return ticket
+
+
+    def poll(self, ticket: Ticket):
+        """
+        return whether a queued ticket was admitted
+            - raise AdmissionError if it waited too long
+        """
+        with self.cond:
+            return self._poll(ticket)
+
+
+    def admitted(self, ticket: Ticket, instance):
+        """
+        tie an admitted ticket to the instance it started
+        """
+        ticket.instance= instance
+
+
+    def release(self, ticket: Ticket):
+        """
+        give back the slot of an admitted ticket whose instance could not be started
+        """
+        with self.cond:
+            if ticket in self.running:
+                self.running.remove(ticket)
+            self.cond.notify_all()
+
+
+    def summary(self):
+        """
+        return the admission counters and the number of waiting and running tickets
+        """
+        with self.cond:
+            self._reclaim()
+            return dict(self.stats, waiting=len(self.queue), running=len(self.running))
+
+
+    def _poll(self, ticket):
+        # another waiter's poll may have shed or admitted the ticket
+        if ticket.state == 'shed':
+            raise AdmissionError(f"too many instances, waited {self.max_wait:.1f}s")
+        if ticket.state == 'admitted':
+            return ticket in self.running
+
+        self._reclaim()
+        now= time.monotonic()
+        for queued in list(self.queue):
+            if now - queued.queued_at >= self.max_wait:
+                self.queue.remove(queued)
+                queued.state= 'shed'
+                self.stats['shed']+= 1
+                self.cond.notify_all()
+                if queued is ticket:
+                    raise AdmissionError(f"too many instances, waited {now - queued.queued_at:.1f}s")
+                continue
+            if self._fits(queued):
+                if queued is not ticket:
+                    return False
+                self.queue.remove(ticket)
+                self._admit(ticket)
+                return True
+        return False
+
+
+    def _admit(self, ticket):
+        ticket.state= 'admitted'
+        self.running.append(ticket)
+        self.stats['admitted']+= 1
+
+
+    def _fits(self, ticket):
+        self._reclaim()
+        if self.max_instances and len(self.running) >= self.max_instances:
+            return False
+        if self.max_per_client and sum(1 for running in self.running
+                                       if running.client == ticket.client) >= self.max_per_client:
+            return False
+        if self.max_per_token and sum(1 for running in self.running
+                                      if running.token == ticket.token) >= self.max_per_token:
+            return False
+        return True
+
+
+    def _reclaim(self):
+        """
+        drop the slots of instances whose process exited
+        """
+        self.running= [ticket for ticket in self.running
+                       if ticket.instance is None or ticket.instance.alive()]
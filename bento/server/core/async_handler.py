@@ -0,0 +1,307 @@
+import asyncio
+import logging
+
+from . import instance_mngr
+from . import metrics
+from . import tracing
+from .admission import AdmissionError
+from .handler import Handler
+from common.protocol import *
+
+
+""" events of the instances with queued input, set once their input was sent """
+_input_drained= {}
+
+""" watches of the instances whose output a connection waits for """
+_output_watches= {}
+
+
+def _flush_input(instance: instance_mngr.Instance, fd):
+    """
+    send queued input of an instance whose channel became writable
+    """
+    if instance.flush_input():
+        asyncio.get_event_loop().remove_writer(fd)
+        event= _input_drained.pop(instance.function_id, None)
+        if event:
+            event.set()
+
+
+class _OutputWatch:
+    """
+    a reader on an instance's channel shared by every connection waiting for its output, the
+    event loop allows a single reader per file descriptor
+    """
+    def __init__(self, instance: instance_mngr.Instance):
+        self.function_id= instance.function_id
+        self.fd= instance.fileno()
+        self.ready= asyncio.Event()
+        self.waiters= 0
+        asyncio.get_event_loop().add_reader(self.fd, self._readable)
+
+    def _readable(self):
+        self._stop()
+        self.ready.set()
+
+    def _stop(self):
+        asyncio.get_event_loop().remove_reader(self.fd)
+        if _output_watches.get(self.function_id) is self:
+            del _output_watches[self.function_id]
+
+    async def wait(self):
+        self.waiters+= 1
+        try:
+            await self.ready.wait()
+        finally:
+            self.waiters-= 1
+            if not self.waiters and not self.ready.is_set():
+                self._stop()
+
+
+class AsyncHandler(Handler):
+    """
+    serves a client connection as a coroutine so one event loop can serve every client
+        - request handling is shared with Handler, only the I/O is asynchronous
+        - an execute request waits for admission on the event loop, so other clients are
+          served meanwhile
+        - input to functions is queued and sent whenever their channel is writable, requests
+          are not read while an instance the client writes to has InputBytes queued
+    """
+
+    InputBytes= 1024 * 1024
+
+    def __init__(self, reader, writer):
+        super().__init__(writer.get_extra_info('socket'))
+        self.reader= reader
+        self.writer= writer
+        self.output_tasks= {}
+        self.credit_events= {}
+        self.admission= None
+
+
+    async def handle_connection(self):
+        """
+        handle requests and instance messages until the client disconnects
+            - return every instance the client opened so the caller can clean them up
+        """
+        try:
+            await self._serve()
+        finally:
+            # instances stay attached until closed, the reaper skips them otherwise
+            for function_id in list(self.opened):
+                self._close(function_id)
+        return list(self.instances.values())
+
+
+    async def _serve(self):
+        """
+        the loop of handle_connection(), return once the client disconnected or was handed off
+        """
+        while True:
+            try:
+                version, msg_type, data= await self._recv_frame()
+            except (asyncio.IncompleteReadError, ConnectionError) as exc:
+                logging.error(f"failed to recv from client: {exc}")
+                break
+
+            if msg_type == Types.Execute:
+                await self._wait_admission(version, data)
+            self._dispatch(version, msg_type, data)
+            self._release_admission()
+            self._finish_trace()
+            await self.writer.drain()
+            await self._throttle_input()
+            if self.handed_off:
+                break
+
+
+    async def _wait_admission(self, version, data):
+        """
+        wait on the event loop until admission control lets the execute request through, the
+        ticket or the reason it was turned away is kept for _admit()
+        """
+        admission= instance_mngr.admission()
+        try:
+            request= ExecuteRequest.deserialize(data, version)
+            with tracing.span(self.trace, 'admission.wait'):
+                ticket= admission.enqueue(self.client, request.token)
+                while not admission.poll(ticket):
+                    await asyncio.sleep(admission.PollInterval)
+            self.admission= ticket
+        except AdmissionError as exc:
+            self.admission= exc
+        except Exception:
+            # malformed requests are reported by the dispatch
+            self.admission= None
+
+
+    def _admit(self, token):
+        """
+        hand over the outcome of _wait_admission()
+        """
+        outcome, self.admission= self.admission, None
+        if outcome is None:
+            return super()._admit(token)
+        if isinstance(outcome, AdmissionError):
+            raise outcome
+        return outcome
+
+
+    def _release_admission(self):
+        """
+        give back a slot the execute request did not use, e.g. because of an invalid token
+        """
+        outcome, self.admission= self.admission, None
+        if outcome is not None and not isinstance(outcome, AdmissionError):
+            instance_mngr.admission().release(outcome)
+
+
+    def _input_queued(self, instance: instance_mngr.Instance):
+        """
+        send the rest of the instance's input once its channel is writable
+        """
+        if instance.inputq:
+            fd= instance.fileno()
+            asyncio.get_event_loop().add_writer(fd, _flush_input, instance, fd)
+
+
+    async def _throttle_input(self):
+        """
+        wait until every open instance has less than InputBytes of input queued
+        """
+        for instance in list(self.opened.values()):
+            while instance.input_size >= AsyncHandler.InputBytes:
+                event= _input_drained.setdefault(instance.function_id, asyncio.Event())
+                await event.wait()
+
+
+    def _can_hand_off(self):
+        """
+        return whether the connection carries no state another worker would have to take over
+        """
+        return not self.opened and not self.writer.transport.get_write_buffer_size()
+
+
+    def _unread(self):
+        """
+        consume the data the stream reader received but the handler did not read yet
+        """
+        # StreamReader has no public way to take its buffer
+        unread= bytes(self.reader._buffer)
+        self.reader._buffer.clear()
+        return unread
+
+
+    def _open(self, instance: instance_mngr.Instance):
+        """
+        start forwarding the instance's output alongside any other open instance
+        """
+        super()._open(instance)
+        self.output_tasks[instance.function_id]= asyncio.ensure_future(self._forward_output(instance))
+
+
+    def _close(self, function_id):
+        """
+        stop forwarding the instance's output
+        """
+        super()._close(function_id)
+        self.credit_events.pop(function_id, None)
+        task= self.output_tasks.pop(function_id, None)
+        if task:
+            task.cancel()
+
+
+    def _grant(self, function_id, amount):
+        """
+        let an open instance send more output and wake up its forwarding task
+        """
+        super()._grant(function_id, amount)
+        event= self.credit_events.get(function_id)
+        if event:
+            event.set()
+
+
+    async def _forward_output(self, instance: instance_mngr.Instance):
+        """
+        send function output to the client until the function is dead and its output drained
+        """
+        while True:
+            if not self._has_credit(instance.function_id):
+                event= self.credit_events.setdefault(instance.function_id, asyncio.Event())
+                event.clear()
+                await event.wait()
+                continue
+
+            # output stays in the instance's buffer while the transport is full, whatever the
+            # transport holds is lost if the client disconnects
+            if not self._writable():
+                await self.writer.drain()
+                continue
+
+            msg= instance.output.get()
+            if msg is not None:
+                while msg is not None:
+                    self._charge(msg)
+                    self._send_pkt(self._compress(msg))
+                    if not self._writable() or not self._has_credit(instance.function_id):
+                        break
+                    msg= instance.output.get()
+                await self.writer.drain()
+                continue
+
+            if instance.output.done():
+                break
+
+            watch= _output_watches.get(instance.function_id)
+            if watch is None:
+                watch= _output_watches[instance.function_id]= _OutputWatch(instance)
+            await watch.wait()
+            instance.read_output()
+
+        if self.opened.pop(instance.function_id, None):
+            instance.detach()
+        self.credits.pop(instance.function_id, None)
+        self.compressions.pop(instance.function_id, None)
+        self.credit_events.pop(instance.function_id, None)
+        self.output_tasks.pop(instance.function_id, None)
+        logging.debug(f"({instance.function_id}) function dead")
+        self._send_pkt(FunctionErr(instance.function_id, "function dead"))
+
+
+    def _writable(self):
+        """
+        return whether the transport buffers no more than its high-water mark, beyond it the
+        transport pauses writing and drain() waits until it is writable again
+        """
+        transport= self.writer.transport
+        return transport.get_write_buffer_size() <= transport.get_write_buffer_limits()[1]
+
+
+    async def _recv_frame(self):
+        """
+        recv a request or message from the client
+            - requests and function messages share the same header layout
+        """
+        hdr= await self.reader.readexactly(Request.HeaderLen)
+        if Request.versioned(hdr):
+            hdr+= await self.reader.readexactly(Request.V2HeaderLen - Request.HeaderLen)
+
+        version, msg_type, length, err= Request.unpack_versioned_hdr(hdr)
+        if err:
+            raise ConnectionError(f"unpacking header failed {err}")
+
+        # waiting for the header is idle time, so a trace starts with the body
+        self.trace= tracing.start_trace()
+        with tracing.span(self.trace, 'recv.body', length=length):
+            data= await self.reader.readexactly(length)
+        metrics.inc('received_bytes_total', len(hdr) + length)
+        return version, msg_type, data
+
+
+    def _send_pkt(self, response: Response):
+        """
+        send wrapper, buffered by the transport until the next drain
+        """
+        buffers= response.buffers(self.version)
+        self.writer.writelines(buffers)
+        metrics.inc('sent_bytes_total', sum(len(buf) for buf in buffers))
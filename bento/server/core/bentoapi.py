@@ -4,26 +4,41 @@ this file defines the bento api that is exposed to functions executed by clients
 """
 
 
+import atexit
+import os
 import struct
 import sys
 import select
+from threading import Condition, Thread
+import time
 
 
 class StdoutData:
     """
-    data from function stdout: [err][len][data]
+    data from function stdout: [type][len][data]
+        - Data is sent to the client as output, Error as an error message and Log is only
+          logged by the server (the function's stderr)
+        - Stream is a chunk of streamed output and StreamEnd, which has no data, marks the end
+          of a stream
+        - Trace carries the json list of spans a traced driver timed, see tracing
     """
     HeaderLen= 5
     HeaderFmt= ">BI"
 
+    Data, Error, Log, Stream, StreamEnd, Trace= range(6)
+
     def __init__(self, data):
         if isinstance(data, str):
             data= data.encode()
+        elif isinstance(data, memoryview):
+            data= data.cast('B')
         self.data= data
     
     def serialize(self, errbyte):
-        hdr= struct.pack(StdoutData.HeaderFmt, errbyte, len(self.data))
-        return hdr + self.data
+        return b''.join(self.buffers(errbyte))
+
+    def buffers(self, errbyte):
+        return [struct.pack(StdoutData.HeaderFmt, errbyte, len(self.data)), self.data]
 
 
 class StdinData:
@@ -37,26 +52,260 @@ class StdinData:
         self.data= data
     
     def serialize(self):
-        hdr= struct.pack(StdinData.HeaderFmt, len(self.data))
-        return hdr + self.data
+        return b''.join(self.buffers())
+
+    def buffers(self):
+        return [struct.pack(StdinData.HeaderFmt, len(self.data)), self.data]
+
+
+class ExecData:
+    """
+    function handed to a waiting driver:
+    [call len][code len][bytecode len][flags][call][code][bytecode]
+        - an empty bytecode field means the driver compiles the code itself
+        - Trace: the driver times its phases and reports them in a Trace message
+    """
+    HeaderLen= 13
+    HeaderFmt= ">IIIB"
+
+    Trace= 0x1
 
+    def __init__(self, call, code, bytecode=None, flags: int=0):
+        self.call= call.encode() if isinstance(call, str) else call
+        self.code= code.encode() if isinstance(code, str) else code
+        self.bytecode= bytecode or b''
+        self.flags= flags
 
-def send(data):
+    def serialize_hdr(self):
+        return struct.pack(ExecData.HeaderFmt, len(self.call), len(self.code), len(self.bytecode),
+                           self.flags)
+
+    @staticmethod
+    def unpack_hdr(packed_hdr):
+        return struct.unpack(ExecData.HeaderFmt, packed_hdr)
+
+
+""" wall clock time of the function's first output, reported when the driver is traced """
+first_send= None
+
+
+def send(data, block: bool=True):
     """
     pack data len, append the actual data, and send to server
         - will be picked up by the dedicated exchange process for this function
+        - data may be bytes, a bytearray or a memoryview, it is written without being copied
+        - the server stops reading output while the client is behind, send then blocks until
+          the client caught up, with block=False it returns 0 without sending instead
+        - see buffering() to coalesce small messages into fewer writes
     """
+    global first_send
     if data:
-        sys.stdout.buffer.write(StdoutData(data).serialize(0x00))
-        sys.stdout.buffer.flush()
-        return len(data)
+        if not block and not writable():
+            return 0
+        if first_send is None:
+            first_send= time.time()
+        msg= StdoutData(data)
+        _write(msg.buffers(StdoutData.Data))
+        return len(msg.data)
     return 0
+
+
+class OutputStream:
+    """
+    file-like writer that sends output to the client in chunks of at most chunk_size bytes
+        - nothing is buffered, each chunk is written as soon as it is complete so memory use does
+          not depend on the size of the output
+        - close() sends the end-of-stream marker, which ends iter_output() on the client
+    """
+    ChunkSize= 65536
+
+    def __init__(self, chunk_size: int=ChunkSize):
+        self.chunk_size= chunk_size
+        self.closed= False
+
+    def write(self, data):
+        global first_send
+        if self.closed:
+            raise ValueError("write to closed stream")
+        if isinstance(data, str):
+            data= data.encode()
+        view= memoryview(data).cast('B')
+        if first_send is None:
+            first_send= time.time()
+        for pos in range(0, len(view), self.chunk_size):
+            _write(StdoutData(view[pos:pos + self.chunk_size]).buffers(StdoutData.Stream))
+        return len(view)
+
+    def flush(self):
+        flush()
+
+    def close(self):
+        if not self.closed:
+            self.closed= True
+            _write(StdoutData(b'').buffers(StdoutData.StreamEnd))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_stream(chunk_size: int=OutputStream.ChunkSize):
+    """
+    open a stream to write output to in bounded chunks, use it as a context manager or close
+    it to mark the end of the output
+    """
+    return OutputStream(chunk_size)
+
+
+def send_stream(source, chunk_size: int=OutputStream.ChunkSize):
+    """
+    send output in chunks of at most chunk_size bytes followed by the end-of-stream marker
+        - source may be bytes-like, a binary file or any iterable of bytes-like chunks, files
+          are read into a single reused buffer
+        - return the number of bytes sent
+    """
+    sent= 0
+    with open_stream(chunk_size) as stream:
+        if isinstance(source, (bytes, bytearray, memoryview, str)):
+            sent+= stream.write(source)
+        elif hasattr(source, 'readinto'):
+            chunk= bytearray(chunk_size)
+            view= memoryview(chunk)
+            while True:
+                n= source.readinto(chunk)
+                if not n:
+                    break
+                sent+= stream.write(view[:n])
+        else:
+            for data in source:
+                sent+= stream.write(data)
+    return sent
+
+
+def buffering(max_bytes: int=65536, max_delay: float=0.01):
+    """
+    coalesce messages smaller than max_bytes and write them together once max_bytes are
+    buffered, max_delay seconds passed since the oldest one or flush() is called
+        - small messages are copied into the buffer, larger ones are written right away after
+          anything buffered, without being copied
+        - recv() flushes before waiting for input and buffered output is flushed at exit
+        - max_bytes=0 turns buffering off again, max_delay=None only flushes on size
+    """
+    _sendbuff.configure(max_bytes, max_delay)
+
+
+def flush():
+    """
+    write any buffered messages to the server now
+    """
+    _sendbuff.flush()
+
+
+def writable():
+    """
+    return whether output can be sent without blocking, i.e. the server is reading it
+    """
+    return sys.stdout.buffer in select.select([], [sys.stdout.buffer], [], 0)[1]
+
+
+class _SendBuffer:
+    """
+    coalesces small frames written to the server, see buffering()
+    """
+    def __init__(self):
+        self.frames= bytearray()
+        self.since= None
+        self.max_bytes= 0
+        self.max_delay= None
+        self.cond= Condition()
+        self.flusher= None
+
+    def configure(self, max_bytes, max_delay):
+        with self.cond:
+            self._flush()
+            self.max_bytes= max_bytes
+            self.max_delay= max_delay
+            if max_bytes and max_delay is not None and self.flusher is None:
+                self.flusher= Thread(target=self._flush_late, name='api-flush', daemon=True)
+                self.flusher.start()
+                atexit.register(self.flush)
+            self.cond.notify()
+
+    def write(self, buffers):
+        size= sum(len(buf) for buf in buffers)
+        with self.cond:
+            if size >= self.max_bytes:
+                _writev([self.frames] + list(buffers))
+                self.frames.clear()
+                self.since= None
+                return
+
+            for buf in buffers:
+                self.frames+= buf
+            if self.since is None:
+                self.since= time.monotonic()
+                self.cond.notify()
+            if len(self.frames) >= self.max_bytes:
+                self._flush()
+
+    def flush(self):
+        with self.cond:
+            self._flush()
+
+    def _flush(self):
+        if self.frames:
+            _writev([self.frames])
+            self.frames.clear()
+        self.since= None
+
+    def _flush_late(self):
+        """
+        flush frames that were buffered for max_delay seconds
+        """
+        with self.cond:
+            while True:
+                if self.since is None or self.max_delay is None:
+                    self.cond.wait()
+                    continue
+                remaining= self.since + self.max_delay - time.monotonic()
+                if remaining > 0:
+                    self.cond.wait(remaining)
+                    continue
+                self._flush()
+
+_sendbuff= _SendBuffer()
+
+
+def _write(buffers):
+    """
+    write frame buffers to the server, coalescing them with others if buffering is on
+    """
+    _sendbuff.write(buffers)
+
+
+def _writev(buffers):
+    """
+    write buffers to the server back to back with writev, after anything already buffered on
+    stdout
+    """
+    sys.stdout.buffer.flush()
+    fd= sys.stdout.buffer.fileno()
+    views= [memoryview(buf).cast('B') for buf in buffers if len(buf)]
+    while views:
+        written= os.writev(fd, views[:1024])
+        while views and written >= len(views[0]):
+            written-= len(views.pop(0))
+        if written:
+            views[0]= views[0][written:]
         
 
 def recv():
     """
     recv data from the client through our pipe to the server 
     """
+    flush()
     data= sys.stdin.buffer.read(StdinData.HeaderLen)
     datalen,= struct.unpack(StdinData.HeaderFmt, data) 
     data= sys.stdin.buffer.read(datalen)
@@ -11,6 +11,35 @@ class Options:
         self.functions_dir = os.path.join(self.working_dir, 'functions')
         self.instances_dir = os.path.join(self.working_dir, 'instances')
         self.function_cmd = 'python3.6'
+        self.pool_size = 0
+        self.pool_min_idle = None
+        self.server_core = 'thread'
+        self.output_buffer_size = 4 * 1024 * 1024
+        self.function_cache_entries = 1024
+        self.function_cache_bytes = 64 * 1024 * 1024
+        self.compression = True
+        self.compression_threshold = 256
+        self.instance_ttl = 300
+        self.orphan_ttl = 0
+        self.reap_interval = 10
+        self.max_instances = 0
+        self.max_client_instances = 0
+        self.max_token_instances = 0
+        self.admission_queue = 64
+        self.admission_wait = 5.0
+        self.rlimit_cpu = 0
+        self.rlimit_as = 0
+        self.rlimit_nofile = 0
+        self.placement = 'none'
+        self.reserved_cores = 1
+        self.pack_size = 1
+        self.workers = 1
+        self.metrics_host = '127.0.0.1'
+        self.metrics_port = 0
+        self.remote_metrics = False
+        self.trace_rate = 0.0
+        self.trace_file = None
+        self.trace_ring_size = 4096
         self.log_level = logging.DEBUG
 
 opts = Options()
@@ -39,15 +68,112 @@ def parse_cmdline():
             For SGX execution, specify a command like 
             'graphene-sgx/pal_loader graphene-sgx/manifest'
             """)
+    parser.add_argument('--pool-size', type=int, default=opts.pool_size,
+            help=f"""number of idle function drivers to keep pre-spawned (default: {opts.pool_size},
+            which disables the pool)""")
+    parser.add_argument('--pool-min-idle', type=int, default=opts.pool_min_idle,
+            help="""refill the pool in the background once fewer drivers than this are idle
+            (default: the pool size)""")
+    parser.add_argument('--server-core', default=opts.server_core,
+            choices = ['thread', 'asyncio'],
+            help=f"""how client connections are served: a thread per connection or a single
+            asyncio event loop for all connections (default: {opts.server_core})""")
+    parser.add_argument('--output-buffer-size', type=int, default=opts.output_buffer_size,
+            help=f"""bytes of function output buffered in memory per instance before the function
+            blocks on sending (default: {opts.output_buffer_size})""")
+    parser.add_argument('--function-cache-entries', type=int, default=opts.function_cache_entries,
+            help=f"""max number of stored functions kept in memory, 0 disables the cache
+            (default: {opts.function_cache_entries})""")
+    parser.add_argument('--function-cache-bytes', type=int, default=opts.function_cache_bytes,
+            help=f"""max total size of stored functions kept in memory 
+            (default: {opts.function_cache_bytes})""")
+    parser.add_argument('--no-compression', dest='compression', action='store_false',
+            help="""never compress output, even for sessions that asked for it (compressed input
+            is still accepted)""")
+    parser.add_argument('--compression-threshold', type=int, default=opts.compression_threshold,
+            help=f"""smallest message compressed in sessions that asked for compression
+            (default: {opts.compression_threshold})""")
+    parser.add_argument('--instance-ttl', type=int, default=opts.instance_ttl,
+            help=f"""seconds a finished instance no client has open is kept for its output to be
+            read, 0 never reaps finished instances (default: {opts.instance_ttl})""")
+    parser.add_argument('--orphan-ttl', type=int, default=opts.orphan_ttl,
+            help=f"""seconds a running instance no client has open is kept before it is killed,
+            0 lets it run (default: {opts.orphan_ttl})""")
+    parser.add_argument('--reap-interval', type=int, default=opts.reap_interval,
+            help=f"seconds between checks for instances to reap (default: {opts.reap_interval})")
+    parser.add_argument('--max-instances', type=int, default=opts.max_instances,
+            help=f"""max running instances, further execute requests wait for a slot, 0 means no
+            limit, with several workers this and the other instance caps are split between
+            them, rounded down but at least 1 per worker, so a cap below the number of workers
+            allows one instance per worker (default: {opts.max_instances})""")
+    parser.add_argument('--max-client-instances', type=int, default=opts.max_client_instances,
+            help=f"""max running instances per client address, 0 means no limit
+            (default: {opts.max_client_instances})""")
+    parser.add_argument('--max-token-instances', type=int, default=opts.max_token_instances,
+            help=f"""max running instances per function token, 0 means no limit
+            (default: {opts.max_token_instances})""")
+    parser.add_argument('--admission-queue', type=int, default=opts.admission_queue,
+            help=f"""max execute requests waiting for a slot, further ones are turned away
+            (default: {opts.admission_queue})""")
+    parser.add_argument('--admission-wait', type=float, default=opts.admission_wait,
+            help=f"""seconds an execute request waits for a slot before it is turned away
+            (default: {opts.admission_wait})""")
+    parser.add_argument('--rlimit-cpu', type=int, default=opts.rlimit_cpu,
+            help=f"CPU seconds per instance, 0 means no limit (default: {opts.rlimit_cpu})")
+    parser.add_argument('--rlimit-as', type=int, default=opts.rlimit_as,
+            help=f"address space bytes per instance, 0 means no limit (default: {opts.rlimit_as})")
+    parser.add_argument('--rlimit-nofile', type=int, default=opts.rlimit_nofile,
+            help=f"""open files per instance, 0 means no limit
+            (default: {opts.rlimit_nofile})""")
+    parser.add_argument('--placement', default=opts.placement,
+            choices=['none', 'spread', 'packed'],
+            help=f"""pin instances to cores: spread puts each on the least loaded core, packed
+            fills cores in order, none lets them float (default: {opts.placement})""")
+    parser.add_argument('--reserved-cores', type=int, default=opts.reserved_cores,
+            help=f"""cores kept for the server when instances are pinned, at least one per worker
+            (default: {opts.reserved_cores})""")
+    parser.add_argument('--pack-size', type=int, default=opts.pack_size,
+            help=f"""instances per core before packed placement moves on to the next core
+            (default: {opts.pack_size})""")
+    parser.add_argument('--workers', type=int, default=opts.workers,
+            help=f"""server processes sharing the port with SO_REUSEPORT, an instance may be
+            opened through any of them (default: {opts.workers})""")
+    parser.add_argument('--metrics-host', default=opts.metrics_host,
+            help=f"address the metrics endpoint listens on (default: {opts.metrics_host})")
+    parser.add_argument('--metrics-port', type=int, default=opts.metrics_port,
+            help=f"""serve metrics over http on this port, worker n uses port + n, 0 disables the
+            endpoint, metrics are always available through metrics requests
+            (default: {opts.metrics_port})""")
+    parser.add_argument('--remote-metrics', action='store_true', default=opts.remote_metrics,
+            help="""answer metrics requests from any client, by default only clients connecting
+            from a loopback address get them""")
+    parser.add_argument('--trace-rate', type=float, default=opts.trace_rate,
+            help=f"""share of received frames whose handling is traced, 0 disables tracing
+            (default: {opts.trace_rate})""")
+    parser.add_argument('--trace-file', default=opts.trace_file,
+            help="""append trace spans to this file as json lines instead of keeping the most
+            recent ones in memory, where the metrics endpoint serves them on /traces""")
+    parser.add_argument('--trace-ring-size', type=int, default=opts.trace_ring_size,
+            help=f"spans kept in memory without a trace file (default: {opts.trace_ring_size})")
     parser.add_argument('-l', '--log-level', default=opts.log_level,
             choices = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
             help="log level (default: %s)" % logging.getLevelName(opts.log_level))
 
     args = parser.parse_args()
 
-    for name in ('host', 'port', 'function_cmd'):
+    for name in ('host', 'port', 'function_cmd', 'pool_size', 'pool_min_idle',
+            'server_core', 'output_buffer_size', 'function_cache_entries',
+            'function_cache_bytes', 'compression', 'compression_threshold', 'instance_ttl',
+            'orphan_ttl', 'reap_interval', 'max_instances', 'max_client_instances',
+            'max_token_instances', 'admission_queue', 'admission_wait', 'rlimit_cpu', 'rlimit_as',
+            'rlimit_nofile', 'placement', 'reserved_cores', 'pack_size', 'workers', 'metrics_host',
+            'metrics_port', 'remote_metrics', 'trace_rate', 'trace_file', 'trace_ring_size'):
         setattr(opts, name, getattr(args, name))
 
+    # the trace file is relative to where the server was started, not the working dir
+    if opts.trace_file:
+        opts.trace_file = os.path.abspath(opts.trace_file)
+
     # test if the user specified the working dir
     if opts.working_dir != args.working_dir:
         opts.working_dir = os.path.abspath(args.working_dir)
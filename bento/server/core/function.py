@@ -2,29 +2,170 @@
 Create and retrieve Bento functions
 """
 
+from collections import OrderedDict
+import hashlib
+import importlib.util
 import json
+import marshal
 import os
+import struct
+from threading import Lock
 
 from .config import opts
+from . import metrics
+
+
+"""
+============================================================================
+Function cache
+============================================================================
+"""
+
+__cache= OrderedDict()
+__cache_bytes= 0
+__cache_lock= Lock()
+__cache_stats= {'hits': 0, 'misses': 0}
+
+
+def _cache_get(token):
+    """
+    return the cached function for the token and mark it most recently used
+    """
+    with __cache_lock:
+        entry= __cache.get(token)
+        if entry is None:
+            __cache_stats['misses']+= 1
+            return None
+        __cache.move_to_end(token)
+        __cache_stats['hits']+= 1
+        return entry[0]
+
+
+def _cache_put(token, function):
+    """
+    cache a function, evicting the least recently used ones to stay within the configured
+    entry count and byte size
+    """
+    global __cache_bytes
+    size= len(function['name'].encode()) + len(function['code'].encode()) + len(function['bytecode'] or b'')
+    if size > opts.function_cache_bytes or opts.function_cache_entries <= 0:
+        return
+
+    with __cache_lock:
+        if token in __cache:
+            __cache_bytes-= __cache.pop(token)[1]
+        __cache[token]= (function, size)
+        __cache_bytes+= size
+        while len(__cache) > opts.function_cache_entries or __cache_bytes > opts.function_cache_bytes:
+            _, (_, evicted_size)= __cache.popitem(last=False)
+            __cache_bytes-= evicted_size
+
+
+def cache_stats():
+    """
+    return hit/miss counters and current usage of the function cache
+    """
+    with __cache_lock:
+        return dict(__cache_stats, entries=len(__cache), bytes=__cache_bytes)
+
+
+metrics.gauge('function_cache', cache_stats, 'stat')
+
+
+"""
+============================================================================
+Function storage
+============================================================================
+"""
+
+__stored= set()
+__store_lock= Lock()
+
+
+def function_token(name, code):
+    """
+    derive a function's token from its name and code so identical functions share a token
+    """
+    name= name.encode()
+    digest= hashlib.sha256(struct.pack('>I', len(name)))
+    digest.update(name)
+    digest.update(code.encode())
+    return digest.hexdigest()
+
+
+def compile_function(code):
+    """
+    compile function code and marshal the code object, prefixed with the interpreter's magic
+    number so a driver running a different python version can tell it has to recompile
+        - raise SyntaxError (or ValueError, MemoryError, RecursionError) if the code does not
+          compile
+    """
+    byte_code= compile(code, '<inline>', 'exec')
+    return importlib.util.MAGIC_NUMBER + marshal.dumps(byte_code)
+
+
+def store_function(name, code):
+    """
+    compile and store a function under its content token
+        - storing a function that is already stored is only a lookup, stored functions are
+          never removed since instances and clients may hold their token
+        - raise SyntaxError (or ValueError, MemoryError, RecursionError) if the code does not
+          compile
+    """
+    token= function_token(name, code)
+    with __store_lock:
+        stored= token in __stored or os.path.exists(_function_path(token))
+
+    if not stored:
+        bytecode= compile_function(code)
+
+    with __store_lock:
+        if not stored:
+            create_function(token, name, code, bytecode)
+        __stored.add(token)
+    return token
+
 
 def get_function(token):
     """
-    retrieve function from storage medium corresponding to the token
+    retrieve function from cache or the storage medium corresponding to the token
     """
-    filename= f'{opts.functions_dir}/{token}.json'
+    function= _cache_get(token)
+    if function is not None:
+        return function
+
+    filename= _function_path(token)
     if os.path.exists(filename):
         with open(filename) as filein:
             function= json.load(filein)
+        function['bytecode']= None
+        if os.path.exists(_bytecode_path(token)):
+            with open(_bytecode_path(token), 'rb') as filein:
+                function['bytecode']= filein.read()
+        _cache_put(token, function)
         return function
     else:
         return None
 
 
-def create_function(token, name, code):
+def create_function(token, name, code, bytecode=None):
     """
-    write function data to storage medium based on the token
+    write function data, and its compiled code if given, to storage medium based on the token
     """
     function= {'name': name, 'code': code} 
-    filename= f'{opts.functions_dir}/{token}.json'
+    filename= _function_path(token)
     with open(filename, 'w') as outfile:
         json.dump(function, outfile)
+    if bytecode is not None:
+        with open(_bytecode_path(token), 'wb') as outfile:
+            outfile.write(bytecode)
+    function['bytecode']= bytecode
+    _cache_put(token, function)
+
+
+def _function_path(token):
+    return f'{opts.functions_dir}/{token}.json'
+
+
+def _bytecode_path(token):
+    return f'{opts.functions_dir}/{token}.bytecode'
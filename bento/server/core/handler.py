@@ -1,143 +1,313 @@
-import base64
+from collections import deque
+from itertools import islice
+import ipaddress
 import json
 import logging
 from multiprocessing import Process
-import struct
+import socket
 import select
-import uuid
+import struct
+import time
+import zlib
 
 from . import instance_mngr
 from . import function 
-from .bentoapi import StdoutData
+from . import metrics
+from . import tracing
+from . import workers
+from .admission import AdmissionError
+from .bentoapi import ExecData
+from .config import opts
 from common.protocol import *
 
 
+""" request types as named in metrics """
+_request_names= {
+    Types.Store: 'store',
+    Types.Execute: 'execute',
+    Types.Open: 'open',
+    Types.Close: 'close',
+    Types.Metrics: 'metrics',
+}
+
+
+""" errors raised by decoding a request or message the client sent """
+_Malformed= (json.JSONDecodeError, struct.error, UnicodeDecodeError, zlib.error)
+
+
+def _loopback(address):
+    """
+    return whether a peer address is a loopback address
+    """
+    try:
+        return ipaddress.ip_address(address).is_loopback
+    except ValueError:
+        return False
+
+
+class _Frame:
+    """
+    a queued frame: the buffers left to send and, for instance output, the message it was made of
+    """
+    def __init__(self, response: Response, version, msg: FunctionMessage=None):
+        self.buffers= deque(memoryview(buf).cast('B') for buf in response.buffers(version)
+                            if len(buf))
+        self.msg= msg
+        self.compressed= msg is not None and response is not msg
+        self.started= False
+
+
 class Handler():
-    def __init__(self, conn):
+    """
+    handles a client connection: requests and messages for any number of open instances are
+    interleaved on the connection and messages are routed by their function_id
+        - output of an instance the client granted credit for is only sent while credit is
+          left, the instance's output buffer then fills up and the function blocks in api.send,
+          the first window comes with the open request (v2) or a Credit sent just before it (v1)
+        - messages of an instance opened with the Compress flag are compressed for as long as
+          the connection lasts or the function runs, so closing and reopening it keeps the
+          compression streams in step with the client
+        - frames are queued as buffers and every writable event sends as many of them as the
+          socket takes, with a single sendmsg per batch of buffers, output not sent yet goes back
+          to its instance when the instance is closed or the client disconnects
+        - execute requests go through admission control keyed by the client's address, a
+          request waiting for a slot holds up only its own connection
+        - with several worker processes, a connection that opens an instance of another worker
+          before opening any of its own is handed off to that worker
+    """
+
+    """ bytes of instance output moved to the send queue at a time """
+    DrainBytes= 1024 * 1024
+
+    def __init__(self, conn, unread: bytes=b''):
         self.conn= conn
+        self.recvbuff= RecvBuffer(conn)
+        self.recvbuff.feed(unread)
+        self.handed_off= False
+        self.trace= None
+        self.sendq= deque()
+        self.version= Versions.V1
+        self.opened= {}
+        self.instances= {}
+        self.credits= {}
+        self.compressions= {}
+        try:
+            self.client= conn.getpeername()[0]
+        except (OSError, IndexError):
+            self.client= None
         
 
-    def handle_communication(self, instance: instance_mngr.Instance):
+    def handle_connection(self):
         """
-        handle instance messages until client disconnect or function terminated and no output data left
+        handle requests and instance messages until the client disconnects
+            - return every instance the client opened so the caller can clean them up
         """
-        logging.debug(f"({instance.function_id}) handling communication")
+        try:
+            self._serve()
+        finally:
+            # instances stay attached until closed, the reaper skips them otherwise
+            self._unqueue()
+            for function_id in list(self.opened):
+                self._close(function_id)
+        return list(self.instances.values())
 
-        msg_queue= []
 
-        def _handle_disconnect():
-            """push read pointer back to account for unread messages"""
-            pos= instance.readout_handle.tell()
-            for msg in msg_queue:
-                pos-= (len(msg) + StdoutData.HeaderLen)
-            instance.readout_handle.seek(pos)
+    def _serve(self):
+        """
+        the loop of handle_connection(), return once the client disconnected or was handed off
+        """
+        while True:
+            opened= list(self.opened.values())
+            inputs= [self.conn] + [instance for instance in opened if instance.wants_read()]
+            outputs= [self.conn] if self.sendq or self._sendable() else []
+            # frames picked up by an earlier recv are handled without waiting on the socket
+            timeout= 0 if self.recvbuff.buffered() else None
 
-        inputs= [self.conn, instance.readout_handle, instance.readerr_handle]
-        outputs= [self.conn]
-        end_instance= False
-        
-        while not end_instance:
             try:
-                readable, writeable, in_error= select.select(inputs, outputs, [])
+                readable, writeable, in_error= select.select(inputs, outputs, [], timeout)
             except select.error as e:
-                _handle_disconnect()
-
-            if not instance.alive():
-                end_instance= True
-
-            if self.conn in writeable:
-                if msg_queue:
-                    msg= msg_queue.pop(0)
-                    self._send_pkt(msg)
-
-            if self.conn in readable:
-                logging.debug(f"({instance.function_id}) reading from client")
-                try:
-                    msg_type, data= self._recv_msg()
-                except Exception as exc:
-                    logging.error(exc)
-                    return
+                logging.error(e)
+                break
 
-                if msg_type == MsgTypes.Input:
-                    # TODO: check function_id before writing to the instance
-                    msg= Input.deserialize(data)
-                    if instance.alive():
-                        datalen= struct.pack(">I", len(msg.data))
-                        instance.function_proc.stdin.write(datalen + msg.data)
-                        instance.function_proc.stdin.flush()
-                        logging.debug(f"({instance.function_id}) data written to function")
-                
-                elif msg_type == Types.Close:
-                    _handle_disconnect()
-                    return
+            try:
+                if self.conn in writeable:
+                    self._drain()
+
+                if self.conn in readable or self.recvbuff.buffered():
+                    try:
+                        version, msg_type, data= self._recv_request()
+                    except Exception as exc:
+                        logging.error(exc)
+                        break
+                    self._dispatch(version, msg_type, data)
+                    self._finish_trace()
+
+                if self.handed_off:
+                    break
+
+                for instance in opened:
+                    if instance in readable:
+                        instance.read_output()
+                    if instance.output.done() and instance.function_id in self.opened:
+                        self._close(instance.function_id)
+                        self.compressions.pop(instance.function_id, None)
+                        logging.debug(f"({instance.function_id}) function dead")
+                        self._send_pkt(FunctionErr(instance.function_id, "function dead"))
+            except OSError as exc:
+                logging.error(f"connection error: {exc}")
+                break
+
+
+    def _dispatch(self, version, msg_type, data):
+        """
+        route a message to its open instance or handle a request
+        """
+        msg_type, compressed= FunctionMessage.split_type(msg_type)
+
+        try:
+            if msg_type == MsgTypes.Input:
+                msg= Input.deserialize(data)
+                msg.compressed= compressed
+                instance= self.opened.get(msg.function_id)
+                if instance is None:
+                    self._send_pkt(FunctionErr(msg.function_id, "instance not open"))
+                elif compressed and msg.function_id not in self.compressions:
+                    self._send_pkt(FunctionErr(msg.function_id, "compression not negotiated"))
+                elif instance.alive():
+                    if compressed:
+                        self.compressions[msg.function_id].decompress(msg)
+                    instance.write_input(msg.data)
+                    self._input_queued(instance)
+                    logging.debug(f"({instance.function_id}) data written to function")
+
+            elif msg_type == MsgTypes.Credit:
+                msg= Credit.deserialize(data)
+                # v1 clients grant their window just before opening
+                function_id= msg.function_id
+                if function_id in self.opened or instance_mngr.get(function_id) is not None:
+                    self._grant(function_id, msg.amount)
+
+            elif msg_type == Types.Close:
+                metrics.inc('requests_total', type='close')
+                request= CloseRequest.deserialize(data, version)
+                logging.debug(f"Parsing close request for instance: {request.function_id}")
+                self._unqueue(request.function_id)
+                self._close(request.function_id)
 
-                else:
-                    self._send_pkt(FunctionErr(instance.function_id, "invalid msg type"))
+            else:
+                self._dispatch_request(version, msg_type, data)
+        except _Malformed as exc:
+            if msg_type in (MsgTypes.Input, MsgTypes.Credit):
+                logging.error(f"dropping malformed message: {exc}")
+            else:
+                self._send_pkt(ErrorResponse(f"malformed request: {exc}", msg_type))
 
-            if instance.readout_handle in readable:
-                hdr= instance.readout_handle.read(StdoutData.HeaderLen)
-                if len(hdr) == StdoutData.HeaderLen:
-                    end_instance= False
-                    err, datalen= struct.unpack(StdoutData.HeaderFmt, hdr)
-                    data= instance.readout_handle.read(datalen)
-                    while len(data) < datalen:
-                        data+= instance.readout_handle.read(datalen - len(data))
-                    if err:
-                        msg_queue.append(Error(instance.function_id, data))
-                    else:
-                        msg_queue.append(Output(instance.function_id, data))
 
-            if instance.readerr_handle in readable:
-                errdata= ""
-                for line in instance.readerr_handle:
-                    errdata+= line
-                
-                if errdata:
-                    end_instance= False
-                    logging.error(f"({instance.function_id}) Execution error:\n {errdata}")
+    def _open(self, instance: instance_mngr.Instance):
+        """
+        start exchanging messages with an instance
+        """
+        logging.debug(f"({instance.function_id}) handling communication")
+        self.opened[instance.function_id]= instance
+        self.instances[instance.function_id]= instance
+        instance.attach()
+
 
-        logging.debug(f"({instance.function_id}) function dead")
-        self._send_pkt(FunctionErr(instance.function_id, "function dead"))
+    def _close(self, function_id):
+        """
+        stop exchanging messages with an instance, its undelivered output stays buffered
+        """
+        instance= self.opened.pop(function_id, None)
+        if instance:
+            instance.detach()
+        self.credits.pop(function_id, None)
 
 
-    def handle_requests(self) -> instance_mngr.Instance:
+    def _grant(self, function_id, amount):
         """
-        handle requests until a client disconnects or opens an instance
+        let an open instance send amount more bytes of output
         """
-        while True:
-            try:
-                req_type, data= self._recv_request()
-            except Exception as e:
-                logging.error(e)
-                return None                
-
-            if req_type == Types.Store: 
-                request= StoreRequest.deserialize(data)
-                logging.debug("Parsing store request")
-                self._handle_store_request(request)
-                
-            elif req_type == Types.Execute:
-                request= ExecuteRequest.deserialize(data)
-                logging.debug(f"Parsing execute request for token: {request.token}")
-                self._handle_execute_request(request)
-
-            elif req_type == Types.Open:
-                request= OpenRequest.deserialize(data)
-                logging.debug(f"Parsing open request for instance: {request.function_id}")
-                instance= self._handle_open_request(request)
-                if instance:
-                    return instance
+        self.credits[function_id]= self.credits.get(function_id, 0) + amount
+
+
+    def _has_credit(self, function_id):
+        """
+        return whether output of an instance may be sent, a message may overdraw what is left
+        """
+        return self.credits.get(function_id, 1) > 0
 
+
+    def _compress(self, msg: FunctionMessage):
+        """
+        compress an output message if its session asked for compression
+        """
+        compression= self.compressions.get(msg.function_id)
+        return compression.compress(msg) if compression else msg
+
+
+    def _charge(self, msg: FunctionMessage):
+        """
+        take the size of an output message from the credit of its instance
+        """
+        if msg.function_id in self.credits:
+            self.credits[msg.function_id]-= len(msg.data)
+
+
+    def _dispatch_request(self, version, req_type, data):
+        """
+        parse and handle a single request
+            - responses are sent in the protocol version of the request
+        """
+        if version not in Versions.Supported:
+            self.version= Versions.Latest
+            self._send_pkt(ErrorResponse(f'unsupported protocol version: {version}', req_type))
+            return
+        self.version= version
+        name= _request_names.get(req_type, 'invalid')
+        metrics.inc('requests_total', type=name)
+        start= time.perf_counter()
+
+        if req_type == Types.Store: 
+            request= StoreRequest.deserialize(data, version)
+            logging.debug("Parsing store request")
+            self._handle_store_request(request)
+            
+        elif req_type == Types.Execute:
+            with tracing.span(self.trace, 'request.decode'):
+                request= ExecuteRequest.deserialize(data, version)
+            logging.debug(f"Parsing execute request for token: {request.token}")
+            self._handle_execute_request(request)
+
+        elif req_type == Types.Open:
+            request= OpenRequest.deserialize(data, version)
+            logging.debug(f"Parsing open request for instance: {request.function_id}")
+            self._handle_open_request(request)
+
+        elif req_type == Types.Metrics:
+            if opts.remote_metrics or _loopback(self.client):
+                self._send_pkt(MetricsResponse(metrics.exposition()))
             else:
-                self._send_pkt(ErrorResponse('invalid request', req_type))
+                self._send_pkt(ErrorResponse('metrics are only served to local clients', req_type))
+
+        else:
+            self._send_pkt(ErrorResponse('invalid request', req_type))
+            return
+
+        metrics.observe('request_seconds', time.perf_counter() - start, type=name)
 
 
     def _handle_store_request(self, request: StoreRequest):
         """
-        generate a unique id and store the funciton code and name
+        store the function code and name under its content token
         """
-        token= str(uuid.uuid4())
-        function.create_function(token, request.name, request.code)
+        try:
+            token= function.store_function(request.name, request.code)
+        except (SyntaxError, ValueError, MemoryError, RecursionError) as exc:
+            # hostile code can exhaust the compiler too, e.g. with very long or deeply nested
+            # expressions
+            errmsg= str(exc) or type(exc).__name__
+            self._send_pkt(ErrorResponse(f"failed to compile: {errmsg}", Types.Store))
+            return
         self._send_pkt(StoreResponse(token))
 
 
@@ -145,83 +315,238 @@ class Handler():
         """
         get the function data and start an instance
         """
-        function_data= function.get_function(request.token)
+        with tracing.span(self.trace, 'function.lookup'):
+            function_data= function.get_function(request.token)
         
-        if function_data is not None:
-            exec_data= {"call": request.call, "code": function_data['code']}
-            exec_data= base64.urlsafe_b64encode(json.dumps(exec_data).encode()).decode()
-            new_instance= instance_mngr.create(exec_data)
-            self._send_pkt(ExecuteResponse(new_instance.function_id))
-        else:
+        if function_data is None:
             self._send_pkt(ErrorResponse("invalid token", Types.Execute))
+            return
+
+        try:
+            with tracing.span(self.trace, 'admission'):
+                ticket= self._admit(request.token)
+        except AdmissionError as exc:
+            logging.warning(f"execute request of {self.client} turned away: {exc}")
+            self._send_pkt(ErrorResponse(f"server busy: {exc}", Types.Execute))
+            return
+
+        exec_data= ExecData(request.call, function_data['code'], function_data['bytecode'])
+        try:
+            new_instance= instance_mngr.create(exec_data, self.trace)
+        except Exception:
+            instance_mngr.admission().release(ticket)
+            raise
+        instance_mngr.admission().admitted(ticket, new_instance)
+        self._input_queued(new_instance)
+        self._send_pkt(ExecuteResponse(new_instance.function_id))
+
+
+    def _input_queued(self, instance: instance_mngr.Instance):
+        """
+        input was written to an instance, cores that queue input send the rest of it later
+        """
+        pass
+
+
+    def _admit(self, token):
+        """
+        wait for admission control to let the client start an instance of the function
+        """
+        return instance_mngr.admission().acquire(self.client, token)
 
     
     def _handle_open_request(self, request: OpenRequest):
         """
-        get and return the instance requested
+        get the instance requested and start exchanging messages with it
+            - a failed open is reported to v2 clients as a FunctionErr of the instance, since
+              successful opens get no response an error response could not be told apart
         """
         instance= instance_mngr.get(request.function_id)
-        if instance is None:
-            self._send_pkt(ErrorResponse(f"no instance exists with id: {request.function_id}", Types.Open))
-            return None
+        worker= instance_mngr.owner(request.function_id) if instance is None else None
+        if worker is not None and self._can_hand_off():
+            self._hand_off(worker, request)
+        elif instance is None:
+            errmsg= f"no instance exists with id: {request.function_id}"
+            if self.version == Versions.V1:
+                self._send_pkt(ErrorResponse(errmsg, Types.Open))
+            else:
+                self._send_pkt(FunctionErr(request.function_id, errmsg))
+        elif instance.function_id not in self.opened:
+            if request.flags & OpenRequest.Compress and instance.function_id not in self.compressions:
+                threshold= opts.compression_threshold if opts.compression else None
+                self.compressions[instance.function_id]= Compression(threshold)
+            if request.window is not None:
+                self.credits[instance.function_id]= request.window
+            self._open(instance)
 
-        return instance
+
+    def _can_hand_off(self):
+        """
+        return whether the connection carries no state another worker would have to take over
+        """
+        return not self.opened and not self.sendq
 
 
-    def _recv_msg(self):
+    def _hand_off(self, worker, request: OpenRequest):
         """
-        recv a message from client to function
+        pass the connection to the worker owning the requested instance, the open request is
+        handled again by that worker
         """
-        hdr= self._recv_all(FunctionMessage.HeaderLen)
-        if not hdr:
-            raise ConnectionError("failed to recv header")
-        
-        msg_type, length, err= FunctionMessage.unpack_hdr(hdr)
-        if err:
-            raise ConnectionError(f"unpacking header failed {err}")
+        logging.debug(f"({request.function_id}) handing connection off to worker {worker}")
+        unread= request.serialize(self.version) + self._unread()
+        workers.hand_off(worker, self.conn, unread)
+        self.handed_off= True
 
-        data= self._recv_all(length)
-        if not data:
-            raise ConnectionError("failed to recv packet data")
 
-        return msg_type, data
-        
+    def _unread(self):
+        """
+        consume the data received from the client but not handled yet
+        """
+        return self.recvbuff.take()
+
 
     def _recv_request(self):
         """
         recv a request from client to server
+            - requests and function messages share the v1 header layout, the first byte tells
+              whether the header is a v2 one
+            - data is a memoryview into the receive buffer
         """
-        hdr= self._recv_all(Request.HeaderLen)
-        if not hdr:
-            raise ConnectionError("failed to recv header")
+        self.trace= tracing.start_trace()
+        with tracing.span(self.trace, 'recv.header'):
+            first= self.recvbuff.peek(1)
+            if first is None:
+                raise ConnectionError("failed to recv header")
+
+            hdrlen= Request.V2HeaderLen if Request.versioned(first) else Request.HeaderLen
+            hdr= self.recvbuff.read(hdrlen)
+            if hdr is None:
+                raise ConnectionError("failed to recv header")
             
-        req_type, length, err= Request.unpack_hdr(hdr)
+        version, req_type, length, err= Request.unpack_versioned_hdr(hdr)
         if err:
             raise ConnectionError(f"unpacking header failed {err}")
 
-        data= self._recv_all(length)
-        if not data:
+        with tracing.span(self.trace, 'recv.body', length=length):
+            data= self.recvbuff.read(length)
+        if data is None:
             raise ConnectionError("failed to recv packet data")
 
-        return req_type, data
+        metrics.inc('received_bytes_total', hdrlen + length)
+        return version, req_type, data
 
 
-    def _send_pkt(self, response: Response):
+    def _finish_trace(self):
+        """
+        emit the spans of the frame just handled if it was sampled
+        """
+        if self.trace is not None:
+            self.trace.finish()
+            self.trace= None
+
+
+    def _sendable(self):
+        """
+        return the open instances with output that may be sent
         """
-        send wrapper
+        return [instance for instance in self.opened.values()
+                if instance.output.msgs and self._has_credit(instance.function_id)]
+
+
+    def _drain(self):
+        """
+        send queued frames until the socket would block, queueing the output of open instances
+        round robin whenever the queue ran empty
         """
-        self.conn.sendall(response.serialize())
+        while True:
+            if not self.sendq:
+                queued= 0
+                sendable= self._sendable()
+                while sendable and queued < Handler.DrainBytes:
+                    for instance in sendable:
+                        msg= instance.output.get()
+                        if msg is not None:
+                            self._charge(msg)
+                            self._queue(self._compress(msg), msg)
+                            queued+= len(msg.data)
+                    sendable= self._sendable()
+                if not self.sendq:
+                    return
+            if not self._flush():
+                return
 
 
-    def _recv_all(self, n):
+    def _flush(self):
+        """
+        send queued buffers without blocking, return whether the queue was emptied
+        """
+        while self.sendq:
+            iov= []
+            for frame in self.sendq:
+                iov.extend(islice(frame.buffers, IovMax - len(iov)))
+                if len(iov) >= IovMax:
+                    break
+            try:
+                sent= self.conn.sendmsg(iov, [], socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return False
+            metrics.inc('sent_bytes_total', sent)
+            while sent:
+                frame= self.sendq[0]
+                frame.started= True
+                if sent < len(frame.buffers[0]):
+                    frame.buffers[0]= frame.buffers[0][sent:]
+                    break
+                sent-= len(frame.buffers.popleft())
+                if not frame.buffers:
+                    self.sendq.popleft()
+        return True
+
+
+    def _queue(self, response: Response, msg: FunctionMessage=None):
+        """
+        append a frame to the send queue
+            - the header and the payload are separate buffers so output is never copied
+            - msg is the instance output the frame was made of, it is kept until the frame is sent
+        """
+        frame= _Frame(response, self.version, msg)
+        if frame.buffers:
+            self.sendq.append(frame)
+
+
+    def _unqueue(self, function_id=None):
+        """
+        put queued instance output back into the output of its instance
+            - for function_id only its frames the client has not started to receive go back,
+              compressed ones are still sent to keep the compression stream in step with the
+              client, and so is everything queued before them
+            - without function_id the client is gone and every output frame goes back, partly
+              sent and compressed ones included
+        """
+        kept= deque()
+        unsent= []
+        held= False
+        for frame in reversed(self.sendq):
+            msg= frame.msg
+            if msg is not None and function_id in (None, msg.function_id):
+                if function_id is None or not (held or frame.started or frame.compressed):
+                    unsent.append(msg)
+                    continue
+                held= True
+            kept.appendleft(frame)
+        self.sendq= kept
+
+        for msg in unsent:
+            instance= self.instances.get(msg.function_id)
+            if instance:
+                instance.output.unget(msg)
+
+
+    def _send_pkt(self, response: Response):
         """
-        recv wrapper
+        send wrapper, the frame goes out behind anything already queued and whatever the socket
+        does not take right away is sent on the next writable event
         """
-        data = bytearray()
-        while len(data) < n:
-            packet = self.conn.recv(n - len(data))
-            if not packet:
-                return None
-            data.extend(packet)
-        return data
+        self._queue(response)
+        self._flush()
 
@@ -1,12 +1,28 @@
+from collections import deque
+import glob
+from itertools import islice
+import json
 import logging
 from multiprocessing import Process, Value, Lock
+import os
+import resource
 import shlex
+import socket
+import struct
 import subprocess
 import sys
-from threading import Lock
+from threading import Event, Lock, Thread
+import time
 import uuid
 
+from .admission import Admission
+from .bentoapi import ExecData, StdinData, StdoutData
 from .config import opts
+from . import metrics
+from . import tracing
+from .placement import Placement
+from .pool import WarmPool
+from .ringbuffer import RingBuffer
 
 sys.path.append('..')
 from common.protocol import *
@@ -20,16 +36,64 @@ Instance management
 
 __instances= {}
 __lock= Lock()
+__pool= None
+__reaper= None
+__reaper_stop= Event()
+__reaped= {'finished': 0, 'orphaned': 0, 'output_bytes': 0, 'files': 0}
+__admission= Admission()
+__placement= None
+__registry= None
+__worker= None
 
 
-def create(exec_data):
+def _spawn():
     """
-    generate a unique id and store the instance data in instance map
+    start a driver under a unique id that waits for its function to be handed over
     """
+    instance= Instance(str(uuid.uuid4()))
+    if __placement is not None:
+        __placement.confine(instance)
+    return instance
+
+
+def start_pool():
+    """
+    pre-spawn idle drivers according to the configured pool size
+    """
+    global __pool
+    __pool= WarmPool(_spawn, opts.pool_size, opts.pool_min_idle)
+    __pool.start()
+
+
+def stop_pool():
+    """
+    kill the idle drivers held by the pool
+    """
+    if __pool is not None:
+        __pool.stop()
+
+
+def create(exec_data, trace=None):
+    """
+    take an idle driver (or spawn one), hand it the function and store it in instance map
+        - with a trace, each step is a span and the driver is asked to trace the function
+    """
+    with tracing.span(trace, 'instance.acquire', pooled=__pool is not None):
+        new_instance= __pool.acquire() if __pool is not None else _spawn()
+    if trace is not None:
+        trace.function_id= new_instance.function_id
+        trace.add('instance.spawn', new_instance.spawned_at, new_instance.spawn_seconds)
+        new_instance.trace= trace
+        exec_data.flags|= ExecData.Trace
+    if __placement is not None:
+        with tracing.span(trace, 'instance.place'):
+            __placement.place(new_instance)
+    with tracing.span(trace, 'instance.start'):
+        new_instance.start(exec_data)
     with __lock:
-        function_id= str(uuid.uuid4())
-        new_instance= Instance(function_id, exec_data)
-        __instances[function_id]= new_instance
+        __instances[new_instance.function_id]= new_instance
+    if __registry is not None:
+        __registry[new_instance.function_id]= __worker
     return new_instance
 
 
@@ -38,10 +102,11 @@ def destroy(function_id):
     ensure the function process ends and delete the instance from instance map
     """
     with __lock:
-        if function_id in __instances:
-            if not __instances[function_id].clean():
-                __instances[function_id].kill()
-                del __instances[function_id]
+        instance= __instances.pop(function_id, None)
+    if instance is not None:
+        _unregister(function_id)
+    if instance is not None and not instance.clean():
+        instance.kill()
 
 
 def get(function_id):
@@ -53,6 +118,246 @@ def get(function_id):
             return __instances[function_id]
 
 
+def _instance_counts():
+    with __lock:
+        instances= list(__instances.values())
+    running= sum(1 for instance in instances if instance.alive())
+    return {'running': running, 'finished': len(instances) - running}
+
+
+def _output_buffered():
+    with __lock:
+        instances= list(__instances.values())
+    return {'bytes': sum(instance.output.size for instance in instances),
+            'messages': sum(len(instance.output.msgs) for instance in instances)}
+
+
+metrics.gauge('instances', _instance_counts, 'state')
+metrics.gauge('output_buffered', _output_buffered, 'unit')
+metrics.gauge('pool_idle', lambda: len(__pool.idle) if __pool is not None else 0)
+
+
+def share_registry(registry, worker):
+    """
+    record the instances of this worker process in a registry shared by all workers
+        - registry maps a function_id to the worker owning the instance
+    """
+    global __registry, __worker
+    __registry= registry
+    __worker= worker
+
+
+def _unregister(function_id):
+    """
+    remove a destroyed instance from the registry shared with the other workers
+    """
+    if __registry is not None:
+        __registry.pop(function_id, None)
+
+
+def owner(function_id):
+    """
+    return the worker owning an instance that is not in this worker's instance map, or None
+    """
+    if __registry is None or get(function_id) is not None:
+        return None
+    worker= __registry.get(function_id)
+    return worker if worker != __worker else None
+
+
+"""
+============================================================================
+Admission control
+============================================================================
+"""
+
+def start_admission():
+    """
+    apply the configured instance caps and wait queue to execute requests
+        - with several workers each enforces its share of the caps, rounded down but at least 1,
+          so together they stay within a cap only if it is at least the number of workers, a
+          smaller cap allows up to one instance per worker
+    """
+    global __admission
+    caps= {'max-instances': opts.max_instances, 'max-client-instances': opts.max_client_instances,
+           'max-token-instances': opts.max_token_instances}
+    for name, cap in caps.items():
+        if 0 < cap < opts.workers and not __worker:
+            logging.warning(f"--{name} {cap} is below --workers {opts.workers}, each worker "
+                            f"admits 1 so up to {opts.workers} may run")
+    __admission= Admission(_worker_share(opts.max_instances),
+                           _worker_share(opts.max_client_instances),
+                           _worker_share(opts.max_token_instances),
+                           opts.admission_queue, opts.admission_wait)
+
+
+def _worker_share(cap):
+    return max(cap // opts.workers, 1) if cap > 0 else 0
+
+
+def admission():
+    """
+    return the admission control execute requests go through, it admits everything until
+    start_admission() is called
+    """
+    return __admission
+
+
+metrics.gauge('admission', lambda: __admission.summary(), 'state')
+
+
+def _limit_resources(pid):
+    """
+    apply the configured rlimits to a driver process, 0 leaves a limit as is
+        - applied right after the spawn, the driver runs no function code before the server
+          hands it one
+    """
+    limits= [(resource.RLIMIT_CPU, opts.rlimit_cpu),
+             (resource.RLIMIT_AS, opts.rlimit_as),
+             (resource.RLIMIT_NOFILE, opts.rlimit_nofile)]
+    for limit, value in limits:
+        if value > 0:
+            resource.prlimit(pid, limit, (value, value))
+
+
+"""
+============================================================================
+Instance placement
+============================================================================
+"""
+
+def start_placement(worker=None):
+    """
+    pin the server to its reserved cores and place instances on the others, must run before
+    start_pool() so pooled drivers are kept off the server cores
+        - worker is the index of this process with several workers, each gets its own cores
+    """
+    global __placement
+    if opts.placement == 'none':
+        return
+    if not hasattr(os, 'sched_setaffinity'):
+        logging.warning("instance placement is not supported on this platform")
+        return
+    __placement= Placement(opts.reserved_cores, opts.placement, opts.pack_size,
+                           worker=worker, workers=opts.workers)
+    __placement.pin_server()
+    logging.info(f"server cores: {__placement.server_cores}, "
+                 f"instance cores: {__placement.instance_cores} ({opts.placement})")
+
+
+def placement_loads():
+    """
+    return the number of live instances placed on each instance core
+    """
+    return __placement.loads() if __placement is not None else {}
+
+
+metrics.gauge('core_instances', placement_loads, 'core')
+
+
+"""
+============================================================================
+Instance reaping
+============================================================================
+"""
+
+def start_reaper():
+    """
+    start reaping instances no client has open in the background, see reap()
+    """
+    global __reaper
+    if opts.instance_ttl <= 0 and opts.orphan_ttl <= 0:
+        return
+    __reaper_stop.clear()
+    __reaper= Thread(target=_reap_periodically, name='instance-reaper', daemon=True)
+    __reaper.start()
+
+
+def stop_reaper():
+    """
+    stop the reaper thread
+    """
+    __reaper_stop.set()
+    if __reaper is not None:
+        __reaper.join()
+
+
+def reap():
+    """
+    destroy instances that no client has open
+        - finished instances once they were idle for the instance ttl, so a client can still
+          reconnect and read buffered output in the meantime
+        - running instances once they were idle for the orphan ttl, 0 keeps them running
+        - return what was reclaimed
+    """
+    now= time.monotonic()
+    finished, orphaned= [], []
+    with __lock:
+        for function_id, instance in list(__instances.items()):
+            if instance.clients:
+                continue
+            idle= now - instance.idle_since
+            if not instance.alive():
+                if instance.finished_at is None:
+                    instance.finished_at= now
+                if opts.instance_ttl > 0 and now - instance.finished_at >= opts.instance_ttl \
+                        and idle >= opts.instance_ttl:
+                    finished.append(__instances.pop(function_id))
+            elif opts.orphan_ttl > 0 and idle >= opts.orphan_ttl:
+                orphaned.append(__instances.pop(function_id))
+
+    reclaimed= {'finished': len(finished), 'orphaned': len(orphaned), 'output_bytes': 0, 'files': 0}
+    for instance in finished + orphaned:
+        _unregister(instance.function_id)
+        reclaimed['output_bytes']+= instance.output.size
+        if not instance.clean():
+            instance.kill()
+        reclaimed['files']+= _remove_artifacts(instance.function_id)
+
+    with __lock:
+        for key, count in reclaimed.items():
+            __reaped[key]+= count
+    return reclaimed
+
+
+def reaper_stats():
+    """
+    return what the reaper reclaimed since the server started
+    """
+    with __lock:
+        return dict(__reaped)
+
+
+metrics.gauge('reaped', reaper_stats, 'kind')
+
+
+def _reap_periodically():
+    while not __reaper_stop.wait(opts.reap_interval):
+        try:
+            reclaimed= reap()
+        except Exception as exc:
+            logging.error(f"reaping instances failed: {exc}")
+            continue
+        if reclaimed['finished'] or reclaimed['orphaned']:
+            logging.info(f"reaped {reclaimed['finished']} finished and {reclaimed['orphaned']} "
+                         f"orphaned instances, freed {reclaimed['output_bytes']} bytes of output "
+                         f"and {reclaimed['files']} files")
+
+
+def _remove_artifacts(function_id):
+    """
+    delete files an instance left in the instances directory, return how many
+    """
+    removed= 0
+    for path in glob.glob(os.path.join(opts.instances_dir, f"{function_id}*")):
+        try:
+            os.remove(path)
+            removed+= 1
+        except OSError as exc:
+            logging.error(f"({function_id}) failed to remove {path}: {exc}")
+    return removed
+
+
 """
 ============================================================================
 Function Instance Definition
@@ -62,34 +367,205 @@ Function Instance Definition
 class Instance:
     """
     an Instance is an invokation of a function and holds state for its execution
+        - the driver process is started right away and waits on stdin until start() hands it
+          the function, which lets the warm pool spawn instances ahead of time
+        - all messages to and from the function go over a single socketpair using the
+          StdinData/StdoutData framing
+        - clients counts the connections that have the instance open, the reaper only destroys
+          instances that were idle without any
+        - on the asyncio core input is queued and sent without blocking, the core calls
+          flush_input() whenever the channel is writable until the queue is empty
+        - several connections may have the instance open, read_output() is serialized so only
+          one of them reads the channel at a time
     """
-    def __init__(self, function_id, exec_data):
+
+    """ max bytes read from the channel at once """
+    RecvSize= 65536
+
+    def __init__(self, function_id):
         self.function_id= function_id
         self.function_proc= None
-        self.outbuff_path= f'{opts.instances_dir}/{function_id}.out'
-        self.errbuff_path= f'{opts.instances_dir}/{function_id}.err'
-        self.readout_handle= None
-        self.readerr_handle= None
-        self.writein_handle= None
+        self.channel= None
+        self.output= RingBuffer(opts.output_buffer_size)
+        self.readbuff= bytearray()
+        self.read_lock= Lock()
+        self.clients= 0
+        self.idle_since= time.monotonic()
+        self.finished_at= None
+        self.started_at= None
+        self.spawned_at= None
+        self.spawn_seconds= None
+        self.trace= None
+        self.clients_lock= Lock()
+        self.queue_input= opts.server_core == 'asyncio'
+        self.inputq= deque()
+        self.input_size= 0
 
-        self._execute(exec_data)
+        self._execute()
 
 
-    def _execute(self, exec_data):
+    def _execute(self):
         """
-        execute the function in a defined environment and open handles to read and write data 
+        start the driver in a defined environment with one end of a socketpair as its stdin and
+        stdout, the other end is kept as the channel to the function
         """
         cmd= shlex.split(opts.function_cmd)
         cmd.append('driver.py')
-        cmd.append(exec_data)
 
-        outbuff= open(self.outbuff_path, 'wb')
-        errbuff= open(self.errbuff_path, 'wb')
+        self.channel, function_end= socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.spawned_at= time.time()
+        start= time.perf_counter()
+        try:
+            self.function_proc= subprocess.Popen(cmd, stdin=function_end, stdout=function_end)
+        finally:
+            function_end.close()
+        _limit_resources(self.function_proc.pid)
+        self.spawn_seconds= time.perf_counter() - start
+        metrics.observe('instance_spawn_seconds', self.spawn_seconds)
+
+
+    def fileno(self):
+        """
+        the channel is readable when the function sent data or terminated
+        """
+        return self.channel.fileno()
+
+
+    def start(self, exec_data: ExecData):
+        """
+        hand the function call, code and bytecode to the waiting driver over the channel
+        """
+        self.idle_since= time.monotonic()
+        self.started_at= time.perf_counter()
+        self._send([exec_data.serialize_hdr(), exec_data.call, exec_data.code, exec_data.bytecode])
+
+
+    def write_input(self, data):
+        """
+        frame client data and send it to the function
+        """
+        self._send(StdinData(data).buffers())
+
+
+    def _send(self, buffers):
+        if not self.queue_input:
+            send_buffers(self.channel, buffers)
+            return
+        for buf in buffers:
+            view= memoryview(buf).cast('B')
+            if len(view):
+                self.inputq.append(view)
+                self.input_size+= len(view)
+        self.flush_input()
+
+
+    def flush_input(self):
+        """
+        send queued input without blocking, return whether the queue was emptied
+            - input to a function that closed its end of the channel is dropped
+        """
+        while self.inputq:
+            try:
+                sent= self.channel.sendmsg(list(islice(self.inputq, IovMax)), [], socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return False
+            except OSError as exc:
+                logging.error(f"({self.function_id}) dropping {self.input_size} bytes of input: {exc}")
+                self.inputq.clear()
+                self.input_size= 0
+                return True
+            self.input_size-= sent
+            while sent and sent >= len(self.inputq[0]):
+                sent-= len(self.inputq.popleft())
+            if sent:
+                self.inputq[0]= self.inputq[0][sent:]
+        return True
+
+
+    def wants_read(self):
+        """
+        return whether the channel should be read, i.e. the function did not terminate yet and
+        its buffered output is below the budget
+        """
+        return not self.output.ended and not self.output.full()
+
+
+    def read_output(self):
+        """
+        read what the function sent without blocking and move complete messages to the output
+        buffer, end the buffer once the function closed the channel
+            - return right away if another connection is reading the channel
+        """
+        if not self.read_lock.acquire(blocking=False):
+            return
+        try:
+            self._read_output()
+        finally:
+            self.read_lock.release()
+
+
+    def _read_output(self):
+        try:
+            data= self.channel.recv(Instance.RecvSize, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return
+        except OSError as exc:
+            logging.error(f"({self.function_id}) channel error: {exc}")
+            data= b''
+
+        if not data:
+            self.output.end()
+            return
+
+        self.readbuff.extend(data)
+        pos= 0
+        while len(self.readbuff) - pos >= StdoutData.HeaderLen:
+            msgtype, datalen= struct.unpack_from(StdoutData.HeaderFmt, self.readbuff, pos)
+            end= pos + StdoutData.HeaderLen + datalen
+            if len(self.readbuff) < end:
+                break
+            data= bytes(self.readbuff[pos + StdoutData.HeaderLen:end])
+            pos= end
+
+            if msgtype == StdoutData.Log:
+                logging.error(f"({self.function_id}) Execution error:\n {data.decode(errors='replace')}")
+            elif msgtype == StdoutData.Error:
+                self.output.put(Error(self.function_id, data))
+            elif msgtype == StdoutData.Stream:
+                self.output.put(Stream(self.function_id, data))
+            elif msgtype == StdoutData.StreamEnd:
+                self.output.put(StreamEnd(self.function_id, data))
+            elif msgtype == StdoutData.Trace:
+                if self.trace is not None:
+                    self.trace.add_driver(json.loads(data), self.spawned_at)
+            else:
+                self.output.put(Output(self.function_id, data))
+        del self.readbuff[:pos]
 
-        self.function_proc= subprocess.Popen(cmd, stdout=outbuff, stdin=subprocess.PIPE, stderr=errbuff)
-        self.writein_handle= self.function_proc.stdin
-        self.readout_handle= open(self.outbuff_path, 'rb')
-        self.readerr_handle= open(self.errbuff_path, 'r')
+        if pos and self.started_at is not None:
+            elapsed= time.perf_counter() - self.started_at
+            metrics.observe('first_output_seconds', elapsed)
+            if self.trace is not None:
+                self.trace.add('first_output', time.time() - elapsed, elapsed)
+            self.started_at= None
+
+
+    def attach(self):
+        """
+        a client opened the instance
+        """
+        with self.clients_lock:
+            self.clients+= 1
+
+
+    def detach(self):
+        """
+        a client closed the instance, it is idle from now on if it was the last one
+        """
+        with self.clients_lock:
+            self.clients-= 1
+            if self.clients == 0:
+                self.idle_since= time.monotonic()
 
 
     def alive(self):
@@ -104,13 +580,10 @@ class Instance:
         attempt to clean up instance processes and artifacts if function has completed execution
             - return whether cleanup was successful
         """
-        if self.function_proc.poll is not None: 
+        if self.function_proc.poll() is not None: 
             self.function_proc.wait()
-            if self.readout_handle:
-                self.readout_handle.close()
-            if self.readerr_handle:
-                self.readerr_handle.close()
-            # TODO: remove output file 
+            self.channel.close()
+            self.output.close()
             return True
         else:
             return False
@@ -120,8 +593,9 @@ class Instance:
         """
         force kill the function process and cleanup
         """
-        if self.function_proc.poll is None: 
+        if self.function_proc.poll() is None: 
             logging.info(f"({self.function_id}) killing instance")
             self.function_proc.kill()
+            self.function_proc.wait()
         self.clean()
 
@@ -0,0 +1,182 @@
+"""
+Server metrics: counters, fixed-bucket histograms and gauges
+"""
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+
+from . import tracing
+
+
+""" upper bounds in seconds of the latency histogram buckets """
+LatencyBuckets= (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+""" prefix of every metric name in the exposition """
+Prefix= 'bento_'
+
+
+class Histogram:
+    """
+    counts observations into fixed buckets, each count covers values up to the bucket's bound
+    """
+    def __init__(self, buckets=LatencyBuckets):
+        self.buckets= buckets
+        self.counts= [0] * (len(buckets) + 1)
+        self.sum= 0
+        self.count= 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)]+= 1
+        self.sum+= value
+        self.count+= 1
+
+
+"""
+============================================================================
+Recording
+============================================================================
+"""
+
+__counters= {}
+__histograms= {}
+__gauges= {}
+__lock= Lock()
+
+
+def inc(name, amount=1, **labels):
+    """
+    add amount to a counter
+    """
+    key= (name, tuple(sorted(labels.items())))
+    with __lock:
+        __counters[key]= __counters.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+    """
+    add an observation, e.g. a latency in seconds, to a histogram
+    """
+    key= (name, tuple(sorted(labels.items())))
+    with __lock:
+        histogram= __histograms.get(key)
+        if histogram is None:
+            histogram= __histograms[key]= Histogram()
+        histogram.observe(value)
+
+
+def gauge(name, collect, label='key'):
+    """
+    register a gauge whose value collect() returns when metrics are read
+        - collect may return a number or a dict of numbers, which become a gauge per key with
+          the key as the value of label
+    """
+    with __lock:
+        __gauges[name]= (collect, label)
+
+
+"""
+============================================================================
+Exposition
+============================================================================
+"""
+
+def exposition() -> str:
+    """
+    render every metric in the prometheus text format
+    """
+    with __lock:
+        counters= dict(__counters)
+        histograms= {key: (histogram.buckets, list(histogram.counts), histogram.sum,
+                           histogram.count) for key, histogram in __histograms.items()}
+        gauges= dict(__gauges)
+
+    lines= []
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f'# TYPE {Prefix}{name} counter')
+        for (key, labels), value in sorted(counters.items()):
+            if key == name:
+                lines.append(f'{Prefix}{name}{_labels(labels)} {value}')
+
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f'# TYPE {Prefix}{name} histogram')
+        for (key, labels), (buckets, counts, total, count) in sorted(histograms.items()):
+            if key != name:
+                continue
+            cumulative= 0
+            for bound, bucket_count in zip(buckets + ('+Inf',), counts):
+                cumulative+= bucket_count
+                lines.append(f'{Prefix}{name}_bucket{_labels(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{Prefix}{name}_sum{_labels(labels)} {total}')
+            lines.append(f'{Prefix}{name}_count{_labels(labels)} {count}')
+
+    for name, (collect, label) in sorted(gauges.items()):
+        try:
+            value= collect()
+        except Exception as exc:
+            logging.error(f"failed to collect gauge {name}: {exc}")
+            continue
+        lines.append(f'# TYPE {Prefix}{name} gauge')
+        if isinstance(value, dict):
+            for key, item in sorted(value.items(), key=lambda item: str(item[0])):
+                lines.append(f'{Prefix}{name}{_labels(((label, key),))} {item}')
+        else:
+            lines.append(f'{Prefix}{name} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+"""
+============================================================================
+HTTP endpoint
+============================================================================
+"""
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    http.server.ThreadingHTTPServer, which python 3.6 does not have yet
+    """
+    daemon_threads= True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """
+    serves /metrics and, as json lines, the spans kept in memory by tracing on /traces
+    """
+    def do_GET(self):
+        if self.path == '/metrics':
+            body= exposition().encode()
+            content_type= 'text/plain; version=0.0.4'
+        elif self.path == '/traces':
+            body= ''.join(json.dumps(span) + '\n' for span in tracing.recent()).encode()
+            content_type= 'application/x-ndjson'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"metrics endpoint: {format % args}")
+
+
+def start_http(host, port):
+    """
+    serve the exposition on http://host:port/metrics from a background thread
+    """
+    server= _ThreadingHTTPServer((host, port), _MetricsHandler)
+    Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
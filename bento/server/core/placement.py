@@ -0,0 +1,104 @@
+"""
+Core placement of function instances
+"""
+
+import logging
+import os
+from threading import Lock
+
+
+class Placement:
+    """
+    pins the server and its instances to disjoint sets of cores
+        - the first reserved of the cores the server may run on are kept for the server's own
+          threads, instances run on the rest
+        - spread puts an instance on the core running the fewest instances, packed fills cores
+          in order with up to pack_size instances each and only then spreads
+        - idle drivers may run on any instance core until they are placed, a core's load is the
+          number of placed instances that are still alive
+        - with several workers at least one core is reserved per worker, and worker n of workers
+          gets the n-th slice of both the server and the instance cores, so workers neither share
+          a server core nor count each other's instances, as long as there are enough cores
+    """
+
+    Modes= ('spread', 'packed')
+
+    def __init__(self, reserved: int=1, mode: str='spread', pack_size: int=1, cores=None,
+                 worker: int=None, workers: int=1):
+        cores= sorted(os.sched_getaffinity(0) if cores is None else cores)
+        if worker is not None:
+            reserved= max(reserved, workers)
+        reserved= min(max(reserved, 0), len(cores) - 1)
+        if reserved == 0:
+            logging.warning(f"instance placement: {len(cores)} core(s) available, the server shares "
+                            "them with its instances")
+        self.server_cores= cores[:reserved] or cores
+        self.instance_cores= cores[reserved:]
+        if worker is not None:
+            self.server_cores= _share(self.server_cores, worker, workers)
+            self.instance_cores= _share(self.instance_cores, worker, workers)
+        self.mode= mode
+        self.pack_size= max(pack_size, 1)
+        self.placed= {core: [] for core in self.instance_cores}
+        self.lock= Lock()
+
+
+    def pin_server(self):
+        """
+        restrict the calling process, and the threads it starts later, to the server cores
+        """
+        os.sched_setaffinity(0, self.server_cores)
+
+
+    def confine(self, instance):
+        """
+        let a not yet placed instance run on any instance core
+        """
+        self._pin(instance, self.instance_cores)
+
+
+    def place(self, instance):
+        """
+        pick a core for an instance about to run a function and pin it there
+        """
+        with self.lock:
+            for core in self.placed:
+                self.placed[core]= [placed for placed in self.placed[core] if placed.alive()]
+            core= self._pick()
+            self.placed[core].append(instance)
+        self._pin(instance, [core])
+        return core
+
+
+    def loads(self):
+        """
+        return the number of placed live instances per instance core
+        """
+        with self.lock:
+            return {core: sum(1 for placed in instances if placed.alive())
+                    for core, instances in self.placed.items()}
+
+
+    def _pick(self):
+        if self.mode == 'packed':
+            for core in self.instance_cores:
+                if len(self.placed[core]) < self.pack_size:
+                    return core
+        return min(self.instance_cores, key=lambda core: len(self.placed[core]))
+
+
+    def _pin(self, instance, cores):
+        try:
+            os.sched_setaffinity(instance.function_proc.pid, cores)
+        except OSError as exc:
+            # the process may already be gone
+            logging.debug(f"({instance.function_id}) failed to pin to cores {cores}: {exc}")
+
+
+def _share(cores, worker, workers):
+    """
+    return the slice of cores that belongs to a worker, workers share cores if there are too few
+    """
+    if len(cores) < workers:
+        return [cores[worker % len(cores)]]
+    return cores[worker * len(cores) // workers:(worker + 1) * len(cores) // workers]
@@ -0,0 +1,92 @@
+"""
+Warm pool of pre-spawned function drivers
+"""
+
+import logging
+from threading import Condition, Thread
+import time
+
+
+class WarmPool:
+    """
+    keeps a number of already started driver processes idle so an execute request does not pay for
+    an interpreter cold start
+        - factory: callable returning a new idle item, items must support alive() and kill()
+        - size: number of idle items the pool refills to, 0 disables the pool
+        - min_idle: refill in the background once fewer than this many items are idle
+    """
+    def __init__(self, factory, size, min_idle=None):
+        self.factory= factory
+        self.size= max(size, 0)
+        self.min_idle= self.size if min_idle is None else min(max(min_idle, 0), self.size)
+        self.idle= []
+        self.cond= Condition()
+        self.running= False
+        self.thread= None
+
+
+    def start(self):
+        """
+        start the background refill thread
+        """
+        if self.size == 0:
+            return
+        self.running= True
+        self.thread= Thread(target=self._refill, name='warm-pool', daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        """
+        stop refilling and kill any idle items
+        """
+        with self.cond:
+            self.running= False
+            idle, self.idle= self.idle, []
+            self.cond.notify_all()
+        for item in idle:
+            item.kill()
+
+
+    def acquire(self):
+        """
+        hand out an idle item, falling back to a cold start when the pool is empty
+        """
+        with self.cond:
+            while self.idle:
+                item= self.idle.pop()
+                if len(self.idle) < self.min_idle:
+                    self.cond.notify()
+                if item.alive():
+                    return item
+                item.kill()
+            self.cond.notify()
+        return self.factory()
+
+
+    def _refill(self):
+        """
+        spawn items until the pool is full whenever it drops below its low watermark
+        """
+        while True:
+            with self.cond:
+                while self.running and len(self.idle) >= self.min_idle and self.idle:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                missing= self.size - len(self.idle)
+
+            for _ in range(missing):
+                try:
+                    item= self.factory()
+                except Exception as exc:
+                    logging.error(f"warm pool failed to spawn: {exc}")
+                    time.sleep(1)
+                    break
+                with self.cond:
+                    if not self.running:
+                        item.kill()
+                        return
+                    self.idle.append(item)
+
+            logging.debug(f"warm pool refilled: {len(self.idle)} idle")
@@ -0,0 +1,82 @@
+"""
+Bounded in-memory buffer for function output
+"""
+
+from collections import deque
+from threading import Lock
+
+
+class RingBuffer:
+    """
+    holds messages read from a function until a client takes them
+        - the total payload size is bounded by capacity: callers stop reading from the function
+          while the buffer is full, which in turn blocks the function once its channel fills up
+    """
+    def __init__(self, capacity):
+        self.capacity= capacity
+        self.msgs= deque()
+        self.size= 0
+        self.ended= False
+        self.lock= Lock()
+
+
+    def put(self, msg):
+        """
+        append a message
+        """
+        with self.lock:
+            self.msgs.append(msg)
+            self.size+= len(msg.data)
+
+
+    def get(self):
+        """
+        pop the oldest message, return None if there is none
+        """
+        with self.lock:
+            if not self.msgs:
+                return None
+            msg= self.msgs.popleft()
+            self.size-= len(msg.data)
+            return msg
+
+
+    def unget(self, msg):
+        """
+        put a message that was taken but not delivered back in front of the others
+        """
+        with self.lock:
+            self.msgs.appendleft(msg)
+            self.size+= len(msg.data)
+
+
+    def full(self):
+        """
+        return whether the buffered payload reached the capacity
+        """
+        return self.size >= self.capacity
+
+
+    def end(self):
+        """
+        mark that no more messages will be put
+        """
+        self.ended= True
+
+
+    def done(self):
+        """
+        return whether the buffer ended and every message has been taken
+        """
+        with self.lock:
+            return self.ended and not self.msgs
+
+
+    def close(self):
+        """
+        drop any buffered messages
+        """
+        with self.lock:
+            self.ended= True
+            self.msgs.clear()
+            self.size= 0
@@ -0,0 +1,154 @@
+"""
+Sampled latency tracing of request handling and instance startup
+"""
+
+from collections import deque
+from contextlib import contextmanager
+import json
+import random
+from threading import Lock
+import time
+import uuid
+
+
+class RingSink:
+    """
+    keeps the most recent spans in memory
+    """
+    def __init__(self, size: int=4096):
+        self.spans= deque(maxlen=size)
+
+    def emit(self, span):
+        self.spans.append(span)
+
+    def recent(self):
+        return list(self.spans)
+
+
+class JsonlSink:
+    """
+    appends every span to a file as a line of json
+    """
+    def __init__(self, path):
+        self.file= open(path, 'a', buffering=1)
+        self.lock= Lock()
+
+    def emit(self, span):
+        line= json.dumps(span) + '\n'
+        with self.lock:
+            self.file.write(line)
+
+    def recent(self):
+        return []
+
+
+class _NoSpan:
+    """
+    stands in for the span of a frame that is not sampled, like contextlib.nullcontext, which
+    python 3.6 does not have yet
+    """
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+class Trace:
+    """
+    spans of one sampled frame, from receiving it to the instance it started sending output
+        - spans are held until finish() so they all carry the function_id, which is only known
+          once an instance was created, spans added later are emitted right away
+        - start is a wall clock time so spans of the driver process line up, durations are in
+          seconds
+    """
+    def __init__(self, sink):
+        self.sink= sink
+        self.trace_id= uuid.uuid4().hex[:16]
+        self.function_id= None
+        self.spans= []
+        self.finished= False
+
+    @contextmanager
+    def span(self, name, **attrs):
+        start= time.time()
+        counter= time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.perf_counter() - counter, **attrs)
+
+    def add(self, name, start, duration, **attrs):
+        span= dict(attrs, trace=self.trace_id, name=name, start=start, duration=duration)
+        if self.finished:
+            self._emit(span)
+        else:
+            self.spans.append(span)
+
+    def add_driver(self, spans, spawned_at=None):
+        """
+        add the spans a driver reported, with the interpreter startup if it was spawned at
+        spawned_at
+        """
+        for span in spans:
+            if span['name'] == 'driver.ready':
+                if spawned_at is not None:
+                    self.add('driver.startup', spawned_at, span['start'] - spawned_at)
+                continue
+            self.add(span['name'], span['start'], span['duration'])
+
+    def finish(self):
+        """
+        emit the spans collected while the frame was handled
+        """
+        self.finished= True
+        spans, self.spans= self.spans, []
+        for span in spans:
+            self._emit(span)
+
+    def _emit(self, span):
+        span['function_id']= self.function_id
+        self.sink.emit(span)
+
+
+"""
+============================================================================
+Sampling
+============================================================================
+"""
+
+__sink= None
+__rate= 0.0
+__nospan= _NoSpan()
+
+
+def configure(sink, rate):
+    """
+    trace a share rate of the frames received into sink, rate 0 disables tracing
+    """
+    global __sink, __rate
+    __sink= sink
+    __rate= rate
+
+
+def start_trace():
+    """
+    return a Trace if the frame about to be received is sampled, None otherwise
+    """
+    if __sink is None or not __rate or random.random() >= __rate:
+        return None
+    return Trace(__sink)
+
+
+def span(trace, name, **attrs):
+    """
+    time a with block as a span of trace, or do nothing if it is not sampled
+    """
+    return trace.span(name, **attrs) if trace is not None else __nospan
+
+
+def recent():
+    """
+    return the spans kept in memory by the sink
+    """
+    return __sink.recent() if __sink is not None else []
@@ -0,0 +1,113 @@
+"""
+Handoff of client connections between the worker processes of a multi-process server
+"""
+
+from array import array
+import logging
+import os
+import socket
+import struct
+from threading import Thread
+
+from .config import opts
+
+
+"""
+============================================================================
+Connection handoff
+============================================================================
+"""
+
+""" header of a handoff: length of the data the sending worker received but did not handle """
+HandoffHdr= struct.Struct('>I')
+
+
+def handoff_path(worker):
+    """
+    path of the unix socket a worker accepts handed off connections on
+    """
+    return os.path.join(opts.working_dir, f'worker-{worker}.sock')
+
+
+def hand_off(worker, conn: socket.socket, unread: bytes):
+    """
+    pass a client connection and the data received on it but not handled yet to another worker
+        - the caller keeps its own copy of the connection and must close it without shutting
+          it down
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(handoff_path(worker))
+        msg= HandoffHdr.pack(len(unread)) + unread
+        fds= array('i', [conn.fileno()])
+        sent= sock.sendmsg([msg], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+        # the receiving worker closes its end once it has the whole message
+        if sent < len(msg):
+            sock.sendall(msg[sent:])
+
+
+def start_handoff_listener(worker, on_connection):
+    """
+    accept connections handed off by other workers in the background
+        - on_connection(conn, unread) is called on the listener thread for every connection
+    """
+    path= handoff_path(worker)
+    if os.path.exists(path):
+        os.remove(path)
+    sock= socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen()
+    Thread(target=_accept_handoffs, args=(sock, on_connection), name='handoff-listener',
+           daemon=True).start()
+
+
+def stop_handoff_listener(worker):
+    """
+    remove the worker's handoff socket, handoffs to it fail from then on
+    """
+    path= handoff_path(worker)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _accept_handoffs(sock, on_connection):
+    while True:
+        peer, _= sock.accept()
+        try:
+            conn, unread= _recv_handoff(peer)
+        except (OSError, ValueError) as exc:
+            logging.error(f"failed to receive handed off connection: {exc}")
+            continue
+        finally:
+            peer.close()
+        try:
+            on_connection(conn, unread)
+        except Exception as exc:
+            # e.g. the client reset the connection while it was handed off
+            logging.error(f"failed to serve handed off connection: {exc}")
+            conn.close()
+
+
+def _recv_handoff(peer):
+    """
+    recv a handed off connection and the unread data that came along
+    """
+    fds= array('i')
+    msg, ancdata, _, _= peer.recvmsg(65536, socket.CMSG_SPACE(fds.itemsize))
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[:len(data) - len(data) % fds.itemsize])
+    if len(fds) != 1 or len(msg) < HandoffHdr.size:
+        for fd in fds:
+            os.close(fd)
+        raise ValueError("malformed handoff")
+
+    conn= socket.socket(fileno=fds[0])
+    length,= HandoffHdr.unpack_from(msg)
+    unread= bytearray(msg[HandoffHdr.size:])
+    while len(unread) < length:
+        data= peer.recv(length - len(unread))
+        if not data:
+            conn.close()
+            raise ValueError("truncated handoff")
+        unread+= data
+    return conn, bytes(unread)
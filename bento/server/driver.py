@@ -2,50 +2,129 @@
 Executed in an execution broker spawned by server
 """
 
+from contextlib import contextmanager
+import importlib.util
 import json
-import base64
+import marshal
 import sys
+import time
 
 import core.bentoapi as bentoapi
 
+""" when the interpreter was up and the driver imported, reported as driver.ready """
+_ready= time.time()
+
+
+class _StderrChannel:
+    """
+    stands in for stderr so tracebacks and warnings reach the server as framed log messages
+    instead of corrupting the channel
+    """
+    def __init__(self):
+        self.pending= []
+
+    def write(self, data):
+        self.pending.append(data)
+        return len(data)
+
+    def flush(self):
+        if self.pending:
+            data, self.pending= ''.join(self.pending), []
+            bentoapi._write(bentoapi.StdoutData(data).buffers(bentoapi.StdoutData.Log))
+
+
+class _Spans:
+    """
+    times the phases of running a function when the server traces it, see core.tracing
+    """
+    def __init__(self, enabled):
+        self.enabled= enabled
+        self.spans= [{'name': 'driver.ready', 'start': _ready, 'duration': 0}]
+
+    @contextmanager
+    def span(self, name):
+        if not self.enabled:
+            yield
+            return
+        start= time.time()
+        try:
+            yield
+        finally:
+            self.spans.append({'name': name, 'start': start, 'duration': time.time() - start})
+
+    def send(self, call_start):
+        """
+        report the spans, with the time from calling the function to its first output
+        """
+        if not self.enabled:
+            return
+        if bentoapi.first_send is not None:
+            self.spans.append({'name': 'driver.first_send', 'start': call_start,
+                               'duration': bentoapi.first_send - call_start})
+        bentoapi._write(bentoapi.StdoutData(json.dumps(self.spans)).buffers(bentoapi.StdoutData.Trace))
+
 
 def _write_error(data: str):
     """
     write serialized error with errorbyte set to stdout
     """
-    sys.stdout.buffer.write(bentoapi.StdoutData(data).serialize(0x01))
-    sys.stdout.buffer.flush()
+    bentoapi._write(bentoapi.StdoutData(data).buffers(bentoapi.StdoutData.Error))
 
 
-def _execute(code, call):
+def _load(code, bytecode):
+    """
+    load the code object compiled by the server, compiling the code here if there is none or it
+    was compiled by a different python version
+    """
+    magic= importlib.util.MAGIC_NUMBER
+    if bytecode and bytecode[:len(magic)] == magic:
+        return marshal.loads(bytecode[len(magic):])
+    return compile(code, '<inline>', 'exec')
+
+
+def _execute(code, call, bytecode=None, spans=_Spans(False)):
     """
     load the function's context and then execute it
     """
     context = dict(locals(), **globals())
     context['api']= bentoapi
-    byte_code= compile(code, '<inline>', 'exec')
+    with spans.span('driver.load'):
+        byte_code= _load(code, bytecode)
     try:
-        exec(byte_code, context, context)
-        return eval(call, context) 
+        with spans.span('driver.exec'):
+            exec(byte_code, context, context)
+        with spans.span('driver.call'):
+            return eval(call, context) 
     except Exception as e:
         _write_error(str(e)) 
 
 
 def _main():
     """
-    parse function code and call from argument and execute
+    wait for the function code and call on stdin, then parse and execute
+        - the server may start the driver ahead of time and only hand it work later
     """
-    todo= sys.argv[1]
+    sys.stderr= _StderrChannel()
+
+    hdr= sys.stdin.buffer.read(bentoapi.ExecData.HeaderLen)
+    if len(hdr) < bentoapi.ExecData.HeaderLen:
+        # server went away before handing us a function
+        return
+    call_len, code_len, bytecode_len, flags= bentoapi.ExecData.unpack_hdr(hdr)
+    spans= _Spans(bool(flags & bentoapi.ExecData.Trace))
 
-    exec_data= json.loads(base64.urlsafe_b64decode(todo.encode()).decode())
-    
-    call= exec_data['call']
-    code= exec_data['code']
+    with spans.span('driver.read'):
+        call= sys.stdin.buffer.read(call_len).decode()
+        code= sys.stdin.buffer.read(code_len).decode()
+        bytecode= sys.stdin.buffer.read(bytecode_len)
 
     # execute the function and send any return value back
-    retval= _execute(code, call)
+    call_start= time.time()
+    retval= _execute(code, call, bytecode, spans)
     if retval:
         bentoapi.send(retval) 
+    spans.send(call_start)
+    bentoapi.flush()
 
 
 if __name__ == "__main__":
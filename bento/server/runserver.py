@@ -1,16 +1,24 @@
 #!/usr/bin/env python3
 
+import asyncio
 import logging
+from multiprocessing import Process
+from multiprocessing.managers import SyncManager
+import os
 from select import EPOLLONESHOT
+import signal
 import socket
-import time
 from threading import Thread
 
 import core.config as config
 from core.config import opts
 
+from core.async_handler import AsyncHandler
 from core.handler import Handler
 import core.instance_mngr as instance_mngr
+import core.metrics as metrics
+import core.tracing as tracing
+import core.workers as workers
 
 logging.basicConfig(format='%(levelname)s:\t%(message)s', level=opts.log_level)
 
@@ -19,48 +27,69 @@ class ClientThread(Thread):
     """
     interact with a client
     """
-    def __init__(self, address, port, conn):
+    def __init__(self, address, port, conn, unread=b''):
         Thread.__init__(self)
         self.address= address
         self.port= port
         self.conn= conn
-        self.instance= None
-        self.handler= Handler(conn)
+        self.handler= Handler(conn, unread)
 
 
     def run(self):
-        while True:
-            self.instance= self.handler.handle_requests()
-            if self.instance:
-                self.handler.handle_communication(self.instance)
-            else:
-                # no instance opened - client disconnect
-                self._handle_disconnect()
-                break
+        instances= self.handler.handle_connection()
+        if self.handler.handed_off:
+            logging.info(f"client handed off: {self.address}:{self.port}")
+            self.conn.close()
+        self._handle_disconnect(instances)
 
 
-    def _clean_instance(self):
+    def _handle_disconnect(self, instances):
         """
-        clean up the client's connection to an instance
-            - the instance may continue to run while no clients are interacting with it 
+        leave the client's instances to the reaper
         """
-        if self.instance:
-            logging.debug(f"({self.instance.function_id}) cleaning up instance")
-            if not self.instance.clean():
-                logging.debug(f"({self.instance.function_id}) function still running")
-            else:
-                logging.debug(f"({self.instance.function_id}) function terminated")
-                instance_mngr.destroy(self.instance.function_id)
-            self.instance= None
+        logging.info(f"client disconnect: {self.address}:{self.port}")
+        for instance in instances:
+            _clean_instance(instance)
 
 
-    def _handle_disconnect(self):
-        """
-        wait a sec before cleaning the client's instance 
-        """
-        logging.info(f"client disconnect: {self.address}:{self.port}")
-        time.sleep(1)
-        self._clean_instance()
+async def _serve_client(reader, writer):
+    """
+    interact with a client on the shared event loop
+    """
+    address, port= writer.get_extra_info('peername')[:2]
+    logging.info(f"New connection from {address}:{port}")
+
+    handler= AsyncHandler(reader, writer)
+    instances= await handler.handle_connection()
+    writer.close()
+
+    if handler.handed_off:
+        logging.info(f"client handed off: {address}:{port}")
+    logging.info(f"client disconnect: {address}:{port}")
+    for instance in instances:
+        _clean_instance(instance)
+
+
+async def _serve_handed_off(conn, unread):
+    """
+    interact with a client whose connection another worker handed off
+    """
+    reader, writer= await asyncio.open_connection(sock=conn)
+    reader.feed_data(unread)
+    await _serve_client(reader, writer)
+
+
+def _clean_instance(instance):
+    """
+    clean up the client's connection to an instance
+        - the handler already detached the client, the instance and its buffered output are
+          kept for other or reconnecting clients until the reaper destroys it, see
+          instance_mngr.reap()
+    """
+    if instance:
+        state= "still running" if instance.alive() else "terminated"
+        logging.debug(f"({instance.function_id}) function {state}, {instance.clients} client(s) "
+                      "left, kept until reaped")
 
 
 
@@ -78,6 +107,35 @@ def _pr_config():
     logging.debug(f"  functions_dir: {opts.functions_dir}")
     logging.debug(f"  instances_dir: {opts.instances_dir}")
     logging.debug(f"  function_cmd: {opts.function_cmd}")
+    logging.debug(f"  pool_size: {opts.pool_size}")
+    logging.debug(f"  pool_min_idle: {opts.pool_min_idle}")
+    logging.debug(f"  server_core: {opts.server_core}")
+    logging.debug(f"  output_buffer_size: {opts.output_buffer_size}")
+    logging.debug(f"  function_cache_entries: {opts.function_cache_entries}")
+    logging.debug(f"  function_cache_bytes: {opts.function_cache_bytes}")
+    logging.debug(f"  compression: {opts.compression}")
+    logging.debug(f"  compression_threshold: {opts.compression_threshold}")
+    logging.debug(f"  instance_ttl: {opts.instance_ttl}")
+    logging.debug(f"  orphan_ttl: {opts.orphan_ttl}")
+    logging.debug(f"  reap_interval: {opts.reap_interval}")
+    logging.debug(f"  max_instances: {opts.max_instances}")
+    logging.debug(f"  max_client_instances: {opts.max_client_instances}")
+    logging.debug(f"  max_token_instances: {opts.max_token_instances}")
+    logging.debug(f"  admission_queue: {opts.admission_queue}")
+    logging.debug(f"  admission_wait: {opts.admission_wait}")
+    logging.debug(f"  rlimit_cpu: {opts.rlimit_cpu}")
+    logging.debug(f"  rlimit_as: {opts.rlimit_as}")
+    logging.debug(f"  rlimit_nofile: {opts.rlimit_nofile}")
+    logging.debug(f"  placement: {opts.placement}")
+    logging.debug(f"  reserved_cores: {opts.reserved_cores}")
+    logging.debug(f"  pack_size: {opts.pack_size}")
+    logging.debug(f"  workers: {opts.workers}")
+    logging.debug(f"  metrics_host: {opts.metrics_host}")
+    logging.debug(f"  metrics_port: {opts.metrics_port}")
+    logging.debug(f"  remote_metrics: {opts.remote_metrics}")
+    logging.debug(f"  trace_rate: {opts.trace_rate}")
+    logging.debug(f"  trace_file: {opts.trace_file}")
+    logging.debug(f"  trace_ring_size: {opts.trace_ring_size}")
     logging.debug("  log_level: %s" % logging.getLevelName(opts.log_level))
 
 
@@ -86,26 +144,134 @@ def __main():
     config.setup()
     _pr_config()
     logging.getLogger().setLevel(opts.log_level)
+    if opts.workers > 1:
+        _serve_workers()
+    else:
+        _serve()
+
+
+def _serve_workers():
+    """
+    serve the port from several worker processes that share an instance registry
+        - the kernel spreads new connections over the workers with SO_REUSEPORT
+        - the registry lives in a manager process and maps each instance to its worker
+    """
+    manager= SyncManager()
+    manager.start(_ignore_sigint)
+    registry= manager.dict()
+
+    procs= [Process(target=_serve_worker, args=(worker, registry), name=f'worker-{worker}')
+            for worker in range(opts.workers)]
+    for proc in procs:
+        proc.start()
+    try:
+        for proc in procs:
+            proc.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.join()
+        manager.shutdown()
+
+
+def _ignore_sigint():
+    """
+    leave ctrl-c to the main process, which stops the workers before the registry
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _serve_worker(worker, registry):
+    """
+    serve as one of several workers, the main process stops it with SIGTERM
+    """
+    _ignore_sigint()
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    instance_mngr.share_registry(registry, worker)
+    logging.info(f"worker {worker} started, pid {os.getpid()}")
+    try:
+        _serve(worker)
+    except KeyboardInterrupt:
+        pass
+
+
+def _serve(worker=None):
+    """
+    serve the port, worker is the index of this process when there are several
+    """
+    instance_mngr.start_placement(worker)
+    instance_mngr.start_pool()
+    instance_mngr.start_reaper()
+    instance_mngr.start_admission()
+    if opts.trace_rate > 0:
+        sink= (tracing.JsonlSink(opts.trace_file) if opts.trace_file
+               else tracing.RingSink(opts.trace_ring_size))
+        tracing.configure(sink, opts.trace_rate)
+    if opts.metrics_port:
+        metrics.start_http(opts.metrics_host, opts.metrics_port + (worker or 0))
 
     sock= socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if worker is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     sock.bind((opts.host, opts.port))
 
     try:
         sock.listen()
         logging.info(f"Listening on {opts.host}:{opts.port}")
+        if opts.server_core == 'asyncio':
+            _serve_async(sock, worker)
+        else:
+            _serve_threaded(sock, worker)
+
+    except socket.error:
+        logging.info("Closing socket...")
+
+    finally:
+        instance_mngr.stop_reaper()
+        instance_mngr.stop_pool()
+        if worker is not None:
+            workers.stop_handoff_listener(worker)
+        sock.close()
+
+
+def _serve_threaded(sock, worker=None):
+    """
+    accept clients and interact with each on its own thread
+    """
+    if worker is not None:
+        workers.start_handoff_listener(worker, lambda conn, unread:
+                ClientThread(*conn.getpeername()[:2], conn, unread).start())
+
+    new_thread= None
+    try:
         while True:
             conn, addr= sock.accept()
             logging.info("New connection from %s:%d" % addr)
             new_thread= ClientThread(addr[0], addr[1], conn)
             new_thread.start()
+    finally:
+        if new_thread:
+            new_thread.join()
 
-    except socket.error:
-        logging.info("Closing socket...")
 
+def _serve_async(sock, worker=None):
+    """
+    accept and interact with all clients on a single event loop
+    """
+    loop= asyncio.get_event_loop()
+    if worker is not None:
+        workers.start_handoff_listener(worker, lambda conn, unread:
+                loop.call_soon_threadsafe(asyncio.ensure_future, _serve_handed_off(conn, unread)))
+    server= loop.run_until_complete(asyncio.start_server(_serve_client, sock=sock))
+    try:
+        loop.run_forever()
     finally:
-        new_thread.join()
-        sock.close()
+        server.close()
+        loop.run_until_complete(server.wait_closed())
 
 
 if __name__ == '__main__':
@@ -11,7 +11,7 @@ import sys
 
 sys.path.append("../..")
 from bento.common.protocol import *
-from bento.client.api import ClientConnection 
+from bento.client.pool import ClientPool
 
 SOCKS_VERSION = 5
 FUNCTION_FILE= "proxy.func"
@@ -20,9 +20,12 @@ DEFAULT_BENTO_ADDR = '127.0.0.1'
 DEFAULT_BENTO_PORT = 8888
 DEFAULT_PROXY_ADDR = '127.0.0.1'
 DEFAULT_PROXY_PORT = 9011
+DEFAULT_POOL_SIZE = 4
 
 # the command-line arguments
 g_args = None
+# warm connections to the Bento server
+g_pool = None
 
 class ThreadingTCPServer(ThreadingMixIn, TCPServer):
     pass
@@ -81,9 +84,9 @@ class SocksProxy(StreamRequestHandler):
         try:
             if cmd == 1:
                 """
-                Connect to the Bento server
+                Take a warm connection to the Bento server
                 """
-                server_conn= ClientConnection(g_args.addr, g_args.port)
+                server_conn= g_pool.acquire()
                 bind_address = server_conn.conn.getsockname()
             else:
                 """
@@ -102,7 +105,10 @@ class SocksProxy(StreamRequestHandler):
         self.connection.sendall(reply)
 
         if reply[1] == 0 and cmd == 1:
-            self.exchange(self.connection, server_conn, address, port)
+            if self.exchange(self.connection, server_conn, address, port):
+                g_pool.release(server_conn)
+            else:
+                g_pool.discard(server_conn)
 
         self.server.close_request(self.request)
 
@@ -110,6 +116,7 @@ class SocksProxy(StreamRequestHandler):
     def exchange(self, cli, server_conn, addr, port):
         """
         Exchange data between client and Bento proxy function
+            - return whether the function finished so the connection can be reused
         """
         function_name= "proxy"
         f= open(f"{FUNCTION_FILE}", 'r')
@@ -131,28 +138,31 @@ class SocksProxy(StreamRequestHandler):
                 logging.debug(f"sending open request")
                 server_conn.send_open_request(session_id)
                 while True:
-                    r, w, e= select.select([cli, server_conn.conn], [], [])
+                    timeout= 0 if server_conn.buffered() else None
+                    r, w, e= select.select([cli, server_conn.conn], [], [], timeout)
 
                     if cli in r:
                         logging.debug("recving client data")
                         cli_data= cli.recv(4096)
-                        if server_conn.send_sessionmsg(session_id, cli_data) <= 0:
-                            logging.debug('could not send data to server')
+                        if len(cli_data) == 0:
+                            logging.debug('client closed connection')
                             break
+                        server_conn.send_input(session_id, cli_data)
                         logging.debug("data sent to server")
 
-                    if server_conn.conn in r:
+                    if server_conn.conn in r or server_conn.buffered():
                         logging.debug("recving server data")
-                        data, session_id, err= server_conn.get_sessionmsg()
-                        if err:
-                            logging.debug(err)
-                            break
+                        msg= server_conn.recv_message(session_id)
+                        if msg.type == MsgTypes.FunctionErr:
+                            logging.debug(msg.data)
+                            return True
 
-                        if cli.send(data) <= 0:
+                        if cli.send(msg.data) <= 0:
                             logging.debug("could not send data to client")
                             break
                         logging.debug("data sent to client")
                 print("done")
+        return False
 
 
 if __name__ == '__main__':
@@ -168,7 +178,10 @@ if __name__ == '__main__':
             help=f"IP address to bind proxy to (default: {DEFAULT_PROXY_ADDR})")
     parser.add_argument('--proxy-port', type=int, default=DEFAULT_PROXY_PORT,
             help=f"proxy's port (default: {DEFAULT_PROXY_PORT})")
+    parser.add_argument('--pool-size', type=int, default=DEFAULT_POOL_SIZE,
+            help=f"warm connections kept to the bento server (default: {DEFAULT_POOL_SIZE})")
     g_args = parser.parse_args()
+    g_pool = ClientPool(g_args.addr, g_args.port, size=g_args.pool_size)
 
     print(f"Listening on {g_args.proxy_addr}:{g_args.proxy_port}")
     print(f"Connecting to bento server at {g_args.addr}:{g_args.port}")
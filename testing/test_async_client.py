@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+"""
+Drive many concurrent sessions from a single event loop with the asyncio client
+"""
+
+import argparse
+import asyncio
+import logging
+import sys
+
+sys.path.append("..")
+from bento.client.api import AsyncClientConnection
+import bento.common.util as util
+
+
+async def session(conn, token, i):
+    """
+    execute one instance of the echo function and exchange a message with it
+    """
+    function_id, errmsg= await conn.send_execute_request("echo()", token)
+    if errmsg is not None:
+        raise Exception(f"error message from server: {errmsg}")
+
+    await conn.send_open_request(function_id)
+    await conn.send_input(function_id, f"hello from session {i}")
+    received= []
+    async for data, err in conn.output(function_id):
+        received.append(data)
+    return received
+
+
+async def run(args):
+    code= """
+def echo():
+    data= api.recv()
+    api.send(data)
+    """
+    conn= await AsyncClientConnection.connect(args.host, args.port)
+    token, errmsg= await conn.send_store_request("echo", code)
+    if errmsg is not None:
+        util.fatal(f"error message from server: {errmsg}")
+
+    logging.debug(f"got token: {token}")
+
+    results= await asyncio.gather(*(session(conn, token, i) for i in range(args.sessions)))
+    for received in results:
+        print(received)
+    await conn.close()
+
+
+@util.timeit
+def main():
+    logging.basicConfig(format='%(levelname)s:\t%(message)s',
+            level=logging.DEBUG)
+
+    parser = argparse.ArgumentParser(
+            description='Run many echo sessions concurrently with the asyncio client')
+    parser.add_argument('host', help="server's IPv4 address (default: 0.0.0.0)",
+            nargs='?', default="0.0.0.0")
+    parser.add_argument('port', type=int, help="server's port (default: 8888)",
+            nargs='?', default=8888)
+    parser.add_argument('-n', '--sessions', type=int, default=100,
+            help="number of concurrent sessions (default: 100)")
+    args = parser.parse_args()
+
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+"""
+Run several functions at once over a single connection
+- output of every instance is interleaved on the connection and told apart by function_id
+"""
+
+import argparse
+import logging
+import sys
+
+sys.path.append("..")
+from bento.client.api import ClientConnection
+from bento.common.protocol import *
+import bento.common.util as util
+
+@util.timeit
+def main():
+    logging.basicConfig(format='%(levelname)s:\t%(message)s',
+            level=logging.DEBUG)
+
+    parser = argparse.ArgumentParser(
+            description='Execute several counting functions concurrently on one connection')
+    parser.add_argument('host', help="server's IPv4 address (default: 0.0.0.0)",
+            nargs='?', default="0.0.0.0")
+    parser.add_argument('port', type=int, help="server's port (default: 8888)",
+            nargs='?', default=8888)
+    parser.add_argument('-n', '--instances', type=int, default=5,
+            help="number of concurrent instances (default: 5)")
+    args = parser.parse_args()
+
+    code= """
+import time
+def count(name):
+    for i in range(3):
+        api.send(f'{name}: {i}')
+        time.sleep(0.1)
+    """
+
+    conn= ClientConnection(args.host, args.port)
+    token, errmsg= conn.send_store_request("count", code)
+    if errmsg is not None:
+        util.fatal(f"error message from server: {errmsg}")
+
+    logging.debug(f"got token: {token}")
+
+    running= set()
+    for i in range(args.instances):
+        function_id, errmsg= conn.send_execute_request(f"count('instance{i}')", token)
+        if errmsg is not None:
+            util.fatal(f"error message from server: {errmsg}")
+        conn.send_open_request(function_id)
+        running.add(function_id)
+
+    while running:
+        msg= conn.recv_message()
+        if msg.type == MsgTypes.FunctionErr:
+            logging.debug(f"({msg.function_id}) {bytes(msg.data)}")
+            running.discard(msg.function_id)
+        else:
+            print(msg.data.tobytes().decode())
+
+
+if __name__ == '__main__':
+    main()
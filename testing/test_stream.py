@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+"""
+Stream a large function result in bounded chunks
+- neither the function, the server nor the client hold more than a chunk of it at a time
+"""
+
+import argparse
+import logging
+import sys
+
+sys.path.append("..")
+from bento.client.api import ClientConnection
+from bento.common.protocol import *
+import bento.common.util as util
+
+@util.timeit
+def main():
+    logging.basicConfig(format='%(levelname)s:\t%(message)s',
+            level=logging.DEBUG)
+
+    parser = argparse.ArgumentParser(
+            description='Stream random data from a function and count it')
+    parser.add_argument('host', help="server's IPv4 address (default: 0.0.0.0)",
+            nargs='?', default="0.0.0.0")
+    parser.add_argument('port', type=int, help="server's port (default: 8888)",
+            nargs='?', default=8888)
+    parser.add_argument('-s', '--size', type=int, default=1 << 30,
+            help="number of bytes to stream (default: 1GiB)")
+    parser.add_argument('-w', '--window', type=int, default=None,
+            help="bytes of output the function may send ahead of the client (default: unlimited)")
+    args = parser.parse_args()
+
+    function_name = 'stream'
+    function_code = util.read_file(f"functions/{function_name}")
+
+    conn= ClientConnection(args.host, args.port, window=args.window)
+    token, errmsg= conn.send_store_request(function_name, function_code)
+    if errmsg is not None:
+        util.fatal(f"error message from server: {errmsg}")
+
+    logging.debug(f"got token: {token}")
+
+    function_id, errmsg= conn.send_execute_request(f"{function_name}({args.size})", token)
+    if errmsg is not None:
+        util.fatal(f"error message from server: {errmsg}")
+
+    logging.debug(f"got function_id: {function_id}")
+    conn.send_open_request(function_id)
+
+    received= 0
+    for chunk in conn.iter_output(function_id):
+        received+= len(chunk)
+    print(f"received: {received}")
+
+    buff= bytearray(16)
+    n= conn.readinto(function_id, buff)
+    print(f"function sent: {buff[:n].decode()}")
+
+
+if __name__ == '__main__':
+    main()